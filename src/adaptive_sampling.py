@@ -0,0 +1,98 @@
+"""Adapt the profiler's sampling frequency to the host load, to bound the profiler's overhead.
+
+The controller maps the host load onto a few discrete bands: band 0 (idle host) samples at the
+operator's maximum frequency, the last band (saturated host) at the operator's minimum one.
+Since changing the frequency means rewriting the config and SIGHUPping the profiler, the band
+only changes when the load clearly crosses a threshold.
+"""
+
+import logging
+import os
+import time
+from typing import Final, List, NamedTuple, Optional, Tuple
+
+from config_builder import ConfigError
+from profiler_metrics import Sample, total
+
+logger = logging.getLogger(__name__)
+
+# 1-minute load average per CPU at which each band (after band 0) starts
+LOAD_THRESHOLDS: Final[Tuple[float, ...]] = (0.5, 0.75, 1.0)
+MAX_BAND: Final[int] = len(LOAD_THRESHOLDS)
+# how far below a band's threshold the load must drop before we step down from that band
+LOAD_HYSTERESIS: Final[float] = 0.1
+# share of the host's CPU capacity the profiler may use before it's throttled, regardless of load
+PROFILER_CPU_BUDGET: Final[float] = 0.01
+
+PROFILER_CPU_METRIC: Final[str] = "otelcol_process_cpu_seconds"
+
+
+class HostLoad(NamedTuple):
+    """Load measurements the controller acts on."""
+
+    load_per_cpu: float
+    """1-minute load average, divided by the number of CPUs."""
+    profiler_cpu_share: Optional[float]
+    """Share (0-1) of the host's CPU capacity used by the profiler, if known."""
+
+
+class ProfilerCpuReading(NamedTuple):
+    """A reading of the profiler's CPU counter, to compute its CPU usage between two hooks."""
+
+    cpu_seconds: float
+    timestamp: float
+
+
+def read_profiler_cpu(samples: Optional[List[Sample]]) -> Optional[ProfilerCpuReading]:
+    """Extract the profiler's CPU counter from its scraped metrics, if available."""
+    if not samples or not any(sample.name.startswith(PROFILER_CPU_METRIC) for sample in samples):
+        return None
+    return ProfilerCpuReading(total(samples, PROFILER_CPU_METRIC), time.time())
+
+
+def measure(
+    previous: Optional[ProfilerCpuReading], current: Optional[ProfilerCpuReading]
+) -> HostLoad:
+    """Measure the host load, and the profiler's CPU usage between two readings."""
+    cpus = os.cpu_count() or 1
+    share = None
+    if previous and current:
+        elapsed = current.timestamp - previous.timestamp
+        used = current.cpu_seconds - previous.cpu_seconds
+        # if the counter went down, the profiler restarted in the meantime
+        if elapsed > 0 and used >= 0:
+            share = used / elapsed / cpus
+    return HostLoad(load_per_cpu=os.getloadavg()[0] / cpus, profiler_cpu_share=share)
+
+
+def target_band(current_band: int, load: HostLoad) -> int:
+    """Return the band the profiler should run in, given the band it's currently running in."""
+    band = sum(load.load_per_cpu >= threshold for threshold in LOAD_THRESHOLDS)
+    if 0 < current_band <= MAX_BAND and band < current_band:
+        # don't step down until the load has clearly dropped, to avoid flapping around a threshold
+        if load.load_per_cpu >= LOAD_THRESHOLDS[current_band - 1] - LOAD_HYSTERESIS:
+            band = current_band
+
+    share = load.profiler_cpu_share
+    if share is not None:
+        if share > PROFILER_CPU_BUDGET:
+            band = max(band, current_band + 1)
+        elif share > PROFILER_CPU_BUDGET / 2:
+            # throttling got the profiler back within budget: stay here rather than bounce back
+            band = max(band, current_band)
+    return min(band, MAX_BAND)
+
+
+def sampling_frequency(band: int, min_frequency: int, max_frequency: int) -> int:
+    """Return the sampling frequency of a band, interpolated between the operator's bounds.
+
+    Raises:
+        ConfigError: if the bounds are inconsistent.
+    """
+    if not 1 <= min_frequency <= max_frequency:
+        raise ConfigError(
+            f"minimum sampling frequency must be between 1 and the sampling frequency "
+            f"({max_frequency}), got {min_frequency}"
+        )
+    band = max(0, min(band, MAX_BAND))
+    return round(max_frequency - (max_frequency - min_frequency) * band / MAX_BAND)
@@ -3,20 +3,30 @@
 # See LICENSE file for licensing details.
 """A Juju charm for OpenTelemetry eBPF Profiler on machines."""
 
+import json
 import logging
 import os
-import time
+import shutil
+import subprocess
+from typing import Optional
 
 from cosl import JujuTopology
 from cosl.reconciler import observe_events, reconcilable_events_machine
 
 import ops
 import ops_tracing
+from opentelemetry import trace
 
 from charms.operator_libs_linux.v2 import snap
 from charms.pyroscope_coordinator_k8s.v0.profiling import ProfilingEndpointRequirer
 from config_manager import ConfigManager
-from config_builder import Port
+from config_builder import (
+    MEMORY_LIMITER_PROCESSOR_NAME,
+    ConfigError,
+    Port,
+    parse_duration,
+    sha256,
+)
 from ops.model import MaintenanceStatus
 from charms.grafana_agent.v0.cos_agent import COSAgentProvider, charm_tracing_config
 from charms.certificate_transfer_interface.v1.certificate_transfer import (
@@ -24,10 +34,15 @@ from charms.certificate_transfer_interface.v1.certificate_transfer import (
 )
 from constants import CA_CERT_PATH
 
+import adaptive_sampling
+import host_capabilities
+import profiler_metrics
 import snap_management
 from machine_lock import MachineLock
+from work_scheduler import WorkScheduler
 
 logger = logging.getLogger(__name__)
+tracer = trace.get_tracer(__name__)
 
 
 class OtelEbpfProfilerCharm(ops.CharmBase):
@@ -35,9 +50,25 @@ class OtelEbpfProfilerCharm(ops.CharmBase):
 
     _snap_name = "otel-ebpf-profiler"
     _service_name = "otel-ebpf-profiler"
+    _stored = ops.StoredState()
+    # how long to wait for the profiler to pick up a new config before restarting it
+    _reload_timeout = 10.0
 
     def __init__(self, framework: ops.Framework):
         super().__init__(framework)
+        self._stored.set_default(
+            reconcile_fingerprint="",
+            memory_limiter_refused=0.0,
+            sampling_band=0,
+            profiler_cpu_seconds=-1.0,
+            profiler_cpu_timestamp=0.0,
+            deferred_fingerprint="",
+            deferred_steps=[],
+            reload_pending=False,
+            config_signature=[],
+            config_generation="",
+            unacked_generation="",
+        )
 
         if not MachineLock(JujuTopology.from_charm(self).identifier).acquire():
             self.unit.status = ops.BlockedStatus(
@@ -45,6 +76,9 @@ class OtelEbpfProfilerCharm(ops.CharmBase):
             )
             return
         self._should_reload_snap = False
+        self._config_error: Optional[str] = None
+        self._scheduler = WorkScheduler(None)
+        self._fingerprint = ""
         self._profiling_requirer = ProfilingEndpointRequirer(self.model.relations["profiling"])
         self._cos_agent = COSAgentProvider(
             self,
@@ -61,6 +95,8 @@ class OtelEbpfProfilerCharm(ops.CharmBase):
         observe_events(self, (ops.UpgradeCharmEvent, ops.InstallEvent), self._setup)
         # events on which we need to tear down things
         observe_events(self, (ops.StopEvent, ops.RemoveEvent), self._teardown)
+        # the sampling band must be updated before the reconcile, which acts on it
+        framework.observe(self.on.update_status, self._on_update_status)
         # events on which we need to do regular config maintenance
         observe_events(self, reconcilable_events_machine, self._reconcile)
 
@@ -74,10 +110,10 @@ class OtelEbpfProfilerCharm(ops.CharmBase):
 
         # Start the snap
         self.unit.status = MaintenanceStatus(f"Starting {self._snap_name} snap")
-        try:
-            self.snap().start(enable=True)
-        except snap.SnapError as e:
-            raise snap_management.SnapServiceError(f"Failed to start {self._snap_name}") from e
+        snap_management.start_snap(self._snap_name, enable=True)
+        # a (re)installed snap or upgraded charm needs a full reconcile, whatever the inputs
+        self._stored.reconcile_fingerprint = ""
+        self._stored.deferred_fingerprint = ""
 
     def _teardown(self):
         """Remove the snap and the config file."""
@@ -86,14 +122,133 @@ class OtelEbpfProfilerCharm(ops.CharmBase):
             self.snap().ensure(state=snap.SnapState.Absent)
         except (snap.SnapError, snap_management.SnapSpecError) as e:
             raise snap_management.SnapInstallError(f"Failed to uninstall {self._snap_name}") from e
+        finally:
+            snap_management.invalidate_snap_state()
         snap_management.cleanup_config()
+        self._stored.reconcile_fingerprint = ""
+        self._stored.deferred_fingerprint = ""
+        self._stored.deferred_steps = []
+        self._stored.reload_pending = False
+        self._stored.unacked_generation = ""
+        self._stored.config_signature = []
 
     def _reconcile(self):
-        self._reconcile_certs()
+        # a previous hook may have rewritten the config, but deferred reloading the profiler
+        self._should_reload_snap = self._stored.reload_pending
+        fingerprint = self._fingerprint = self._reconcile_fingerprint()
+        if (
+            fingerprint == self._stored.reconcile_fingerprint
+            # work a previous hook deferred must be done, whatever the inputs
+            and not self._stored.deferred_steps
+            and not self._stored.reload_pending
+            and self._config_file_unchanged()
+        ):
+            logger.info("reconcile fast path: hit (inputs unchanged), skipping config reconcile")
+            # charm tracing is configured in-process, so it needs to run on every hook
+            self._reconcile_charm_tracing()
+            return
+        logger.info("reconcile fast path: miss (inputs changed), running config reconcile")
+
+        steps = {
+            "certificates": self._reconcile_certs,
+            "config": self._reconcile_config,
+            "reload": self._reconcile_reload,
+        }
+        if fingerprint == self._stored.deferred_fingerprint:
+            # the inputs haven't changed since a previous hook deferred some of the work:
+            # resume from there, so that slow steps can't starve the ones after them
+            logger.info(
+                "resuming deferred reconcile steps: %s", ", ".join(self._stored.deferred_steps)
+            )
+            steps = {
+                name: run for name, run in steps.items() if name in self._stored.deferred_steps
+            }
+        scheduler = self._scheduler = WorkScheduler(self._duration_option("reconcile_time_budget"))
+        for name, run in steps.items():
+            scheduler.add(name, run)
+        deferred = scheduler.run()
+        if self._should_reload_snap and "reload" not in deferred:
+            # the profiler was reloaded, but the budget ran out before it acknowledged the reload
+            deferred.append("reload")
         self._reconcile_charm_tracing()
-        self._reconcile_config()
-        if self._should_reload_snap:
-            self._reload_snap()
+
+        self._stored.reload_pending = self._should_reload_snap and "reload" in deferred
+        self._stored.deferred_steps = deferred
+        if deferred:
+            # what's on disk no longer matches the inputs of the last complete reconcile: going
+            # back to those inputs must not take the fast path
+            self._stored.reconcile_fingerprint = ""
+            self._stored.deferred_fingerprint = fingerprint
+            self._dispatch_deferred_reconcile()
+            return
+        self._stored.deferred_fingerprint = ""
+        # only store the fingerprint once everything went through, so a failed hook retries
+        # and an invalid config keeps being reported
+        if not self._config_error:
+            self._stored.reconcile_fingerprint = fingerprint
+
+    def _config_file_unchanged(self) -> bool:
+        """Whether the config file on disk is still the one we last left there.
+
+        This costs a single stat(); the file is only read if it was touched.
+        """
+        if not self._stored.config_signature:
+            return True
+        signature = snap_management.ConfigSignature(*self._stored.config_signature)
+        if snap_management.config_signature(signature.hash) == signature:
+            return True
+        logger.warning("the profiler config file changed on disk since the last reconcile")
+        return False
+
+    def _duration_option(self, option: str) -> Optional[float]:
+        """Read a duration config option, in seconds; None if it's 0 or invalid."""
+        try:
+            seconds = parse_duration(str(self.config[option]))
+        except ValueError as e:
+            # don't block the reconcile on it, but report the invalid config
+            logger.error("invalid %s, ignoring it: %s", option, e)
+            self._config_error = f"{option}: {e}"
+            return None
+        return seconds or None
+
+    def _dispatch_deferred_reconcile(self):
+        """Run the deferred reconcile steps in a one-shot hook, rather than on the next event.
+
+        The one-shot waits on the machine's hook lock, so it runs after this hook has exited and
+        let any other queued hook on the machine through.
+        """
+        juju_exec = shutil.which("juju-exec")
+        if not juju_exec:
+            logger.info("juju-exec not found: deferred reconcile steps will run on the next hook")
+            return
+        dispatch = f"JUJU_DISPATCH_PATH=hooks/update-status {self.charm_dir / 'dispatch'}"
+        subprocess.Popen(
+            [juju_exec, self.unit.name, dispatch],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def _reconcile_fingerprint(self) -> str:
+        """Hash all the inputs that determine the CA file and the profiler config on disk.
+
+        We hash the raw profiling databags rather than the validated endpoints so that
+        computing the fingerprint stays cheap.
+        """
+        inputs = {
+            "profiling": {
+                str(relation.id): dict(relation.data[relation.app])
+                for relation in self.model.relations["profiling"]
+                if relation.app
+            },
+            "certificates": sorted(self._cert_transfer.get_all_certificates()),
+            "topology": JujuTopology.from_charm(self).as_dict(),
+            "config": dict(self.config),
+            "host_memory_mib": host_capabilities.total_memory_mib(),
+            "sampling_band": self._stored.sampling_band,
+        }
+        return sha256(json.dumps(inputs, sort_keys=True))
 
     def _reconcile_certs(self):
         """Configure certs, which are transferred from a certificate_transfer provider, on disk."""
@@ -122,43 +277,216 @@ class OtelEbpfProfilerCharm(ops.CharmBase):
     def _reconcile_config(self):
         """Configure the otel collector config."""
         config_manager = ConfigManager()
-        config_manager.add_topology_labels(JujuTopology.from_charm(self).as_dict())
-
-        # Profiling integration
-        config_manager.add_profile_forwarding(self._profiling_requirer.get_endpoints())
+        try:
+            samples_per_second = int(self.config["sampling_frequency"])
+            if self.config["adaptive_sampling"]:
+                samples_per_second = adaptive_sampling.sampling_frequency(
+                    self._stored.sampling_band,
+                    min_frequency=int(self.config["min_sampling_frequency"]),
+                    max_frequency=samples_per_second,
+                )
+            config_manager.configure_profiling_receiver(
+                samples_per_second=samples_per_second,
+                reporter_interval=str(self.config["reporter_interval"]),
+                probabilistic_threshold=int(self.config["probabilistic_threshold"]),
+                probabilistic_interval=str(self.config["probabilistic_interval"]),
+                tracers=str(self.config["tracers"]),
+                off_cpu_threshold=float(self.config["off_cpu_threshold"]),
+            )
+            config_manager.add_memory_limiter(
+                limit_mib=int(self.config["memory_limit_mib"]),
+                spike_limit_mib=int(self.config["memory_spike_limit_mib"]),
+                host_memory_mib=host_capabilities.total_memory_mib(),
+            )
+            config_manager.add_profile_filter(
+                include=str(self.config["filter_include"]),
+                exclude=str(self.config["filter_exclude"]),
+            )
+            config_manager.add_topology_labels(JujuTopology.from_charm(self).as_dict())
+            config_manager.add_batching(
+                send_batch_size=int(self.config["batch_send_size"]),
+                send_batch_max_size=int(self.config["batch_max_size"]),
+                timeout=str(self.config["batch_timeout"]),
+            )
+            config_manager.set_exporter_compression(str(self.config["exporter_compression"]))
+            config_manager.configure_exporter_retry(
+                initial_interval=str(self.config["retry_initial_interval"]),
+                max_interval=str(self.config["retry_max_interval"]),
+                max_elapsed_time=str(self.config["retry_max_elapsed_time"]),
+                timeout=str(self.config["exporter_timeout"]),
+            )
+            config_manager.configure_sending_queue(
+                queue_size=int(self.config["sending_queue_size"]),
+                num_consumers=int(self.config["sending_queue_consumers"]),
+                storage_directory=str(self.config["sending_queue_storage_directory"]),
+            )
+            # Profiling integration
+            config_manager.add_profile_forwarding(
+                self._profiling_requirer.get_endpoints(),
+                mode=str(self.config["export_mode"]),
+                # at most one profiler runs per machine, so the unit identifies the host
+                routing_key=f"{self.model.uuid}/{self.unit.name}",
+            )
+        except ConfigError as e:
+            # keep running with the last valid config we wrote
+            logger.error("invalid charm config: %s", e)
+            self._config_error = str(e)
+            return
 
+        # the reconcile inputs determine the config: they identify it for the profiler to report
+        generation = self._fingerprint[:16]
         # If the config file hash has changed, restart the snap
-        config = config_manager.build()
-        if snap_management.update_config(config.config, config.hash):
+        config = config_manager.build(generation)
+        verified = None
+        if self._stored.config_signature:
+            verified = snap_management.ConfigSignature(*self._stored.config_signature)
+        if snap_management.update_config(config.config, config.hash, verified):
             self._should_reload_snap = True
+        signature = snap_management.config_signature(config.hash)
+        self._stored.config_signature = list(signature) if signature else []
+        self._stored.config_generation = generation
+
+    def _reconcile_reload(self):
+        """Hot-reload the profiler if its config or CA file changed."""
+        if self._should_reload_snap:
+            self._should_reload_snap = not self._reload_snap()
 
-    def _reload_snap(self):
+    def _reload_snap(self) -> bool:
+        """Hot-reload the profiler, and verify it picked up the config we last wrote.
+
+        If it doesn't report running that config in time, restart it; if the hook's time budget
+        runs out first, check again in a later hook, and restart it then if it still doesn't.
+        If reloads are coalesced, just schedule one, unless one already is.
+
+        Returns:
+            False if the reload is yet to be verified, in a later hook.
+        """
         self.unit.status = MaintenanceStatus("Reloading snap config")
-        # this may raise; let the charm go to error state
-        snap_management.reload(self._snap_name, self._service_name)
-        if not self.snap().services["otel-ebpf-profiler"]["active"]:
-            # if at this point the snap isn't running, it could be because we've SIGHUPPED it too early
-            # after installing it.
-            self.snap().start(enable=True)
+        generation = self._stored.config_generation
+        with tracer.start_as_current_span("reload") as span:
+            span.set_attribute("config.generation", generation)
+            if window := self._duration_option("reload_coalesce_window"):
+                # the config is already on disk: whichever change comes last within the window,
+                # a single reload picks it up
+                span.set_attribute("reload.coalesced", True)
+                snap_management.schedule_reload(self._snap_name, self._service_name, window)
+                return True
+            samples = profiler_metrics.scrape()
+            # None if it's down, or doesn't report the config it's running: then we can't tell
+            # whether it picks up the new one, which is no reason to restart it
+            running = profiler_metrics.config_generation(samples) if samples else None
+            if self._stored.unacked_generation == generation:
+                # a previous hook reloaded it, but ran out of time before it acknowledged that
+                self._stored.unacked_generation = ""
+                if running in (None, generation):
+                    logger.info("profiler reloaded config %s, or doesn't tell", generation)
+                    return True
+            else:
+                # this may raise; let the charm go to error state
+                snap_management.reload(self._snap_name, self._service_name)
+                if running is None:
+                    logger.info("profiler doesn't report its config; not verifying the reload")
+                    span.set_attribute("reload.verified", False)
+                    return True
+                timeout = self._reload_timeout
+                if (remaining := self._scheduler.remaining()) is not None:
+                    timeout = min(timeout, remaining)
+                elapsed = profiler_metrics.wait_for_config_generation(generation, timeout=timeout)
+                if elapsed is not None:
+                    logger.info("profiler reloaded config %s in %.2fs", generation, elapsed)
+                    span.set_attribute("reload.seconds", elapsed)
+                    return True
+                if timeout < self._reload_timeout:
+                    # restarting it would overrun the budget: give it until a later hook instead
+                    logger.info(
+                        "hook time budget used up before the profiler reloaded config %s; "
+                        "checking again in a later hook",
+                        generation,
+                    )
+                    span.set_attribute("reload.deferred", True)
+                    self._stored.unacked_generation = generation
+                    return False
+
+            logger.warning(
+                "profiler didn't report running config %s after reload; restarting it",
+                generation,
+            )
+            span.set_attribute("reload.fallback", "restart")
+            state = snap_management.service_state(self._snap_name, self._service_name)
+            try:
+                if state.active_state != "active":
+                    # we may have SIGHUPped it too early after installing it
+                    snap_management.start_snap(self._snap_name, enable=True)
+                else:
+                    self.snap().restart()
+            finally:
+                snap_management.invalidate_snap_state()
+            return True
 
     def snap(self) -> snap.Snap:
         """Return the snap object.
 
         This method provides lazy initialization of snap objects, avoiding unnecessary
-        calls to snapd until they're actually needed.
+        calls to snapd until they're actually needed. The snapd state is shared across
+        all lookups within the same hook dispatch.
+        """
+        return snap_management.get_snap(self._snap_name)
+
+    def _on_update_status(self, _: ops.UpdateStatusEvent):
+        """Move the profiler to the sampling band that fits the current host load.
+
+        A band change is an input change for the reconcile that follows, which then rewrites the
+        config and hot-reloads the profiler; as long as the band stays the same, nothing happens.
         """
-        return snap.SnapCache()[self._snap_name]
+        if not self.config["adaptive_sampling"]:
+            self._stored.sampling_band = 0
+            return
+
+        previous = None
+        if self._stored.profiler_cpu_seconds >= 0:
+            previous = adaptive_sampling.ProfilerCpuReading(
+                self._stored.profiler_cpu_seconds, self._stored.profiler_cpu_timestamp
+            )
+        current = adaptive_sampling.read_profiler_cpu(profiler_metrics.scrape())
+        self._stored.profiler_cpu_seconds = current.cpu_seconds if current else -1.0
+        self._stored.profiler_cpu_timestamp = current.timestamp if current else 0.0
+
+        load = adaptive_sampling.measure(previous, current)
+        band = adaptive_sampling.target_band(self._stored.sampling_band, load)
+        if band != self._stored.sampling_band:
+            logger.info(
+                "adaptive sampling: moving from band %d to band %d (load per CPU %.2f, "
+                "profiler CPU share %s)",
+                self._stored.sampling_band,
+                band,
+                load.load_per_cpu,
+                "unknown" if load.profiler_cpu_share is None else f"{load.profiler_cpu_share:.4f}",
+            )
+            self._stored.sampling_band = band
+
+    def _memory_limiter_refusing(self) -> bool:
+        """Whether the memory limiter has refused any profiles since the last hook."""
+        samples = profiler_metrics.scrape()
+        if samples is None:
+            return False
+        refused = profiler_metrics.processor_dropped_items(
+            samples, MEMORY_LIMITER_PROCESSOR_NAME, signal="profiles"
+        )
+        # if the counter went down, the profiler restarted in the meantime
+        refusing = refused > self._stored.memory_limiter_refused
+        self._stored.memory_limiter_refused = refused
+        return refusing
 
     def _on_collect_unit_status(self, e: ops.CollectStatusEvent):
         # set to blocked if the snap isn't running for whatever reason.
-        # it might happen that the snap would take more time than this before it becomes "inactive",
-        # given that we probably just attempted to restart it.
-        # if this happens, the charm will be set to blocked in the next processed event.
-        for _ in range(5):
-            if err_msg := snap_management.check_status(self._snap_name, self._service_name):
-                e.add_status(ops.BlockedStatus(err_msg))
-                break
-            time.sleep(0.1)  # this is usually enough to detect early startup failures
+        # check_status waits (briefly) for the service to settle if it's transitioning, as we might
+        # have just restarted it; if it fails later than that, the charm will be set to blocked in
+        # the next processed event.
+        if err_msg := snap_management.check_status(self._snap_name, self._service_name):
+            e.add_status(ops.BlockedStatus(err_msg))
+
+        if self._config_error:
+            e.add_status(ops.BlockedStatus(f"Invalid config: {self._config_error}"))
 
         # assumption: if this is a testing env, the envvar won't be set
         machine_id = os.getenv("JUJU_MACHINE_ID", "<testing>")
@@ -168,6 +496,16 @@ class OtelEbpfProfilerCharm(ops.CharmBase):
         if not self._profiling_requirer.get_endpoints():
             happy_state_msg += ", no profiling ingester/backend connected"
 
+        if self._memory_limiter_refusing():
+            logger.warning(
+                "the memory limiter is refusing profiles: the profiler is close to its memory "
+                "limit, likely because the profiling backend is slow or unreachable"
+            )
+            happy_state_msg += ", memory limiter refusing profiles"
+
+        if self._stored.deferred_steps:
+            happy_state_msg += f", deferred: {', '.join(self._stored.deferred_steps)}"
+
         e.add_status(ops.ActiveStatus(happy_state_msg))
 
 
@@ -1,15 +1,85 @@
 """Helper module to build the configuration for OpenTelemetry Collector."""
 
+import copy
 import hashlib
 import logging
-from typing import Any, Dict, List, Literal, Optional, Union
+import re
+from typing import Any, Dict, Final, FrozenSet, List, Literal, Optional, Union
 from enum import Enum, unique, IntEnum
 
 import yaml
 
+try:
+    # the libyaml-backed dumper is an order of magnitude faster than the pure-python one
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:  # pragma: nocover
+    from yaml import SafeDumper
+
 logger = logging.getLogger(__name__)
 
 TOPOLOGY_INJECTOR_PROCESSOR_NAME = "resource/profiling-topology-injector"
+BATCH_PROCESSOR_NAME = "batch/profiling"
+MEMORY_LIMITER_PROCESSOR_NAME = "memory_limiter/profiling"
+FILE_STORAGE_EXTENSION_NAME = "file_storage/profiling"
+FILTER_PROCESSOR_NAME = "filter/profiling"
+# resource attribute of the profiler's own telemetry, identifying the config it's running with
+CONFIG_GENERATION_ATTRIBUTE = "charm.config.generation"
+
+# what profiles can be filtered by, as OTTL paths from a profile sample: the eBPF profiler sets
+# the process attributes on each sample, and the container ID on the resource of its profiles
+FILTER_ATTRIBUTES: Final[Dict[str, str]] = {
+    "process_name": 'attributes["process.executable.name"]',
+    "executable_path": 'attributes["process.executable.path"]',
+    "container_id": 'resource.attributes["container.id"]',
+}
+# regular expression syntax Python supports but RE2, the engine of OTTL's IsMatch, doesn't
+_RE2_UNSUPPORTED_GROUPS: Final[Dict[str, str]] = {
+    "(?=": "lookahead",
+    "(?!": "lookahead",
+    "(?<=": "lookbehind",
+    "(?<!": "lookbehind",
+    "(?P=": "backreference",
+    "(?>": "atomic group",
+    "(?(": "conditional",
+}
+_RE2_FLAGS: Final[str] = "imsU"
+_RE2_REPETITION = re.compile(r"\{\d+(,\d*)?\}")
+
+# tracers (interpreters/runtimes) the eBPF profiler can unwind, as accepted by its `Tracers` option
+PROFILER_TRACERS: Final[FrozenSet[str]] = frozenset(
+    {
+        "all",
+        "native",
+        "perl",
+        "php",
+        "python",
+        "hotspot",
+        "ruby",
+        "v8",
+        "dotnet",
+        "go",
+        "labels",
+        "beam",
+        "luajit",
+    }
+)
+MAX_SAMPLES_PER_SECOND: Final[int] = 1000
+# off-CPU events fire on every context switch, orders of magnitude more often than on-CPU samples;
+# recording more than a tenth of them costs more than it tells
+MAX_OFF_CPU_THRESHOLD: Final[float] = 0.1
+EXPORTER_COMPRESSIONS: Final[FrozenSet[str]] = frozenset({"gzip", "zstd", "snappy", "none"})
+MAX_EXPORTER_TIMEOUT_SECONDS: Final[int] = 300
+
+_DURATION_UNITS: Final[Dict[str, float]] = {
+    "ns": 1e-9,
+    "us": 1e-6,
+    "µs": 1e-6,
+    "ms": 1e-3,
+    "s": 1,
+    "m": 60,
+    "h": 3600,
+}
+_DURATION_COMPONENT_RE = re.compile(r"(\d+(?:\.\d*)?|\.\d+)(ns|us|µs|ms|s|m|h)")
 
 
 def sha256(hashable: Union[str, bytes]) -> str:
@@ -29,6 +99,85 @@ def sha256(hashable: Union[str, bytes]) -> str:
     return hashlib.sha256(hashable).hexdigest()
 
 
+def _ottl_string(value: str) -> str:
+    """Quote a string as an OTTL string literal."""
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _re2_unsupported(pattern: str) -> Optional[str]:
+    """Return what in `pattern` isn't supported by RE2, if anything.
+
+    `pattern` must be a valid Python regular expression.
+    """
+    in_class = False
+    idx = 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        if char == "\\":
+            escaped = pattern[idx + 1 : idx + 2]
+            if not in_class and escaped in tuple("123456789"):
+                return "backreference"
+            if escaped == "Z":
+                return "\\Z"
+            idx += 2
+            continue
+        if in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+            idx += 2 if pattern.startswith("^", idx + 1) else 1
+            # a `]` right after the opening `[` (or `[^`) is a literal
+            if pattern.startswith("]", idx):
+                idx += 1
+            continue
+        elif char == "(":
+            for prefix, feature in _RE2_UNSUPPORTED_GROUPS.items():
+                if pattern.startswith(prefix, idx):
+                    return feature
+            flags = re.match(r"\(\?([a-zA-Z-]+)[:)]", pattern[idx:])
+            unsupported_flags = set(flags.group(1)) - set(_RE2_FLAGS + "-") if flags else set()
+            if unsupported_flags:
+                return f"flag {''.join(sorted(unsupported_flags))!r}"
+        else:
+            repetition = _RE2_REPETITION.match(pattern, idx)
+            if char in "*+?" or repetition:
+                end = repetition.end() if repetition else idx + 1
+                # a quantifier right after `(` is part of a group's syntax
+                if char != "?" or pattern[idx - 1 : idx] != "(":
+                    if pattern[end : end + 1] == "?":
+                        end += 1
+                    if pattern[end : end + 1] == "+":
+                        return "possessive quantifier"
+                    idx = end
+                    continue
+        idx += 1
+    return None
+
+
+def parse_duration(duration: str) -> float:
+    """Parse a Go duration string (e.g. '1m30s', '500ms'), as used by the collector, into seconds.
+
+    Raises:
+        ValueError: if the string is not a valid duration.
+    """
+    if duration == "0":
+        return 0
+    seconds = 0.0
+    pos = 0
+    for match in _DURATION_COMPONENT_RE.finditer(duration):
+        if match.start() != pos:
+            break
+        seconds += float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+        pos = match.end()
+    if not duration or pos != len(duration):
+        raise ValueError(f"invalid duration {duration!r}; expected e.g. '500ms', '30s' or '1m30s'")
+    return seconds
+
+
+class ConfigError(Exception):
+    """Raised when the collector config can't be built from the given options."""
+
+
 @unique
 class Port(IntEnum):
     """Ports used by the Otel eBPF profiler."""
@@ -91,27 +240,41 @@ class ConfigBuilder:
             },
         }
         self._exporter_skip_verify = exporter_skip_verify
+        # settings applied to every (non-debug) exporter on build
+        self._exporter_settings: Dict[str, Any] = {}
         self.add_default_config()
 
     @staticmethod
     def hash(cfg: str):
-        """Return the config as a SHA256 hash."""
-        return sha256(yaml.safe_dump(cfg))
+        """Return the SHA256 hash of the config, as rendered by `build`.
 
-    def build(self) -> str:
+        We hash the very same string we write to disk, so the config is only serialized once.
+        """
+        return sha256(cfg)
+
+    def build(self, generation: str = "") -> str:
         """Build the final configuration and return it as a YAML string.
 
         This method performs several important tasks:
+        - Adds the batch processor to each exporter's branch of the profiles pipeline
         - Adds debug exporters to pipelines that don't have any exporters
         - Injects TLS configuration to all receivers if enabled
         - Configures TLS verification settings for all exporters
+        - Applies the common exporter settings (e.g. compression) to all exporters
+        - Tags the profiler's own telemetry with the config generation, if any
+
+        Args:
+            generation: identifier of this config, for the profiler to report it's running it.
 
         Returns:
             str: A YAML string representing the complete configuration.
         """
+        self._add_batching_to_pipelines()
         self._add_missing_debug_exporters()
         self._add_exporter_insecure_skip_verify(self._exporter_skip_verify)
-        return yaml.safe_dump(self._config)
+        self._add_exporter_settings()
+        self._add_config_generation(generation)
+        return yaml.dump(self._config, Dumper=SafeDumper)
 
     def inject_topology_labels(self, topology_labels: dict):
         """Inject jujutopology into the emitted profiles."""
@@ -127,6 +290,319 @@ class ConfigBuilder:
             pipelines=["profiles"],
         )
 
+    def configure_profiling_receiver(
+        self,
+        samples_per_second: int,
+        reporter_interval: str,
+        probabilistic_threshold: int,
+        probabilistic_interval: str,
+        tracers: str,
+        off_cpu_threshold: float = 0.0,
+    ):
+        """Validate and apply the tuning options of the eBPF `profiling` receiver.
+
+        Args:
+            samples_per_second: stack sampling frequency, per CPU.
+            reporter_interval: how often the gathered profiles are flushed down the pipeline.
+            probabilistic_threshold: percentage (1-100) of probabilistic intervals during which
+                the profiler is active; 100 means always on.
+            probabilistic_interval: length of each probabilistic profiling interval.
+            tracers: comma-separated list of interpreter/runtime tracers to enable.
+            off_cpu_threshold: probability (0-MAX_OFF_CPU_THRESHOLD) that an off-CPU event, i.e.
+                a task being switched out, is recorded; 0 disables off-CPU profiling.
+
+        Raises:
+            ConfigError: if any of the options is out of bounds.
+        """
+        if not 1 <= samples_per_second <= MAX_SAMPLES_PER_SECOND:
+            raise ConfigError(
+                f"sampling frequency must be between 1 and {MAX_SAMPLES_PER_SECOND}, "
+                f"got {samples_per_second}"
+            )
+        if not 1 <= probabilistic_threshold <= 100:
+            raise ConfigError(
+                f"probabilistic threshold must be between 1 and 100, got {probabilistic_threshold}"
+            )
+        for name, duration in (
+            ("reporter interval", reporter_interval),
+            ("probabilistic interval", probabilistic_interval),
+        ):
+            try:
+                seconds = parse_duration(duration)
+            except ValueError as e:
+                raise ConfigError(f"{name}: {e}") from e
+            if seconds <= 0:
+                raise ConfigError(f"{name} must be positive, got {duration!r}")
+        tracer_list = [tracer.strip() for tracer in tracers.split(",") if tracer.strip()]
+        if not tracer_list or not PROFILER_TRACERS.issuperset(tracer_list):
+            raise ConfigError(
+                f"invalid tracers {tracers!r}; "
+                f"expected a comma-separated list of {', '.join(sorted(PROFILER_TRACERS))}"
+            )
+
+        if not 0 <= off_cpu_threshold <= MAX_OFF_CPU_THRESHOLD:
+            raise ConfigError(
+                f"off-CPU threshold must be between 0 and {MAX_OFF_CPU_THRESHOLD}, "
+                f"got {off_cpu_threshold}"
+            )
+
+        receiver = self._config["receivers"]["profiling"]
+        receiver.update(
+            {
+                "SamplesPerSecond": samples_per_second,
+                "ReporterInterval": reporter_interval,
+                "ProbabilisticThreshold": probabilistic_threshold,
+                "ProbabilisticInterval": probabilistic_interval,
+                "Tracers": ",".join(tracer_list),
+            }
+        )
+        if off_cpu_threshold:
+            receiver["OffCPUThreshold"] = off_cpu_threshold
+
+    def set_exporter_compression(self, compression: str):
+        """Set the compression algorithm used by all exporters.
+
+        Raises:
+            ConfigError: if the compression algorithm isn't supported.
+        """
+        if compression not in EXPORTER_COMPRESSIONS:
+            raise ConfigError(
+                f"invalid exporter compression {compression!r}; "
+                f"expected one of {', '.join(sorted(EXPORTER_COMPRESSIONS))}"
+            )
+        self._exporter_settings["compression"] = compression
+
+    def configure_exporter_retry(
+        self,
+        initial_interval: str,
+        max_interval: str,
+        max_elapsed_time: str,
+        timeout: str,
+    ):
+        """Configure the retry policy and per-request timeout of all exporters.
+
+        Args:
+            initial_interval: time to wait after the first failure before retrying.
+            max_interval: upper bound on the (exponentially growing) wait between retries.
+            max_elapsed_time: time after which a batch is dropped; "0s" means retry forever.
+            timeout: timeout of each export request.
+
+        Raises:
+            ConfigError: if any of the options is invalid or out of bounds.
+        """
+        seconds = {}
+        for name, duration in (
+            ("retry initial interval", initial_interval),
+            ("retry max interval", max_interval),
+            ("retry max elapsed time", max_elapsed_time),
+            ("exporter timeout", timeout),
+        ):
+            try:
+                seconds[name] = parse_duration(duration)
+            except ValueError as e:
+                raise ConfigError(f"{name}: {e}") from e
+
+        if seconds["retry initial interval"] <= 0:
+            raise ConfigError(f"retry initial interval must be positive, got {initial_interval!r}")
+        if seconds["retry max interval"] < seconds["retry initial interval"]:
+            raise ConfigError(
+                f"retry max interval ({max_interval!r}) must be at least "
+                f"the retry initial interval ({initial_interval!r})"
+            )
+        if 0 < seconds["retry max elapsed time"] < seconds["retry max interval"]:
+            raise ConfigError(
+                f"retry max elapsed time ({max_elapsed_time!r}) must be 0 (retry forever) "
+                f"or at least the retry max interval ({max_interval!r})"
+            )
+        if not 0 < seconds["exporter timeout"] <= MAX_EXPORTER_TIMEOUT_SECONDS:
+            raise ConfigError(
+                f"exporter timeout must be positive and at most {MAX_EXPORTER_TIMEOUT_SECONDS}s, "
+                f"got {timeout!r}"
+            )
+
+        self._exporter_settings["retry_on_failure"] = {
+            "enabled": True,
+            "initial_interval": initial_interval,
+            "max_interval": max_interval,
+            "max_elapsed_time": max_elapsed_time,
+        }
+        self._exporter_settings["timeout"] = timeout
+
+    def configure_sending_queue(self, queue_size: int, num_consumers: int, storage_directory: str):
+        """Configure the sending queue of all exporters.
+
+        If a storage directory is given, the queue is persisted there through a `file_storage`
+        extension, so that queued profiles survive backend outages and profiler restarts
+        without being held in memory. Otherwise, the queue is kept in memory.
+
+        Args:
+            queue_size: maximum number of batches held in the queue.
+            num_consumers: number of concurrent consumers sending batches from the queue.
+            storage_directory: absolute path of the directory to persist the queue in, or "".
+
+        Raises:
+            ConfigError: if any of the options is out of bounds.
+        """
+        if queue_size < 1:
+            raise ConfigError(f"sending queue size must be positive, got {queue_size}")
+        if num_consumers < 1:
+            raise ConfigError(f"sending queue consumers must be positive, got {num_consumers}")
+        if storage_directory and not storage_directory.startswith("/"):
+            raise ConfigError(
+                f"sending queue storage directory must be an absolute path, got {storage_directory!r}"
+            )
+
+        sending_queue: Dict[str, Any] = {
+            "enabled": True,
+            "queue_size": queue_size,
+            "num_consumers": num_consumers,
+        }
+        if storage_directory:
+            self.add_extension(
+                FILE_STORAGE_EXTENSION_NAME,
+                {"directory": storage_directory, "create_directory": True},
+            )
+            sending_queue["storage"] = FILE_STORAGE_EXTENSION_NAME
+        self._exporter_settings["sending_queue"] = sending_queue
+
+    def add_extension(self, name: str, config: Dict[str, Any]):
+        """Add an extension to the configuration and enable it in the service section."""
+        self._config["extensions"][name] = config
+        if name not in self._config["service"]["extensions"]:
+            self._config["service"]["extensions"].append(name)
+
+    def add_profile_filter(
+        self,
+        include: Dict[str, List[str]],
+        exclude: Dict[str, List[str]],
+    ):
+        """Drop the profile samples of unwanted processes, before they're exported.
+
+        Both arguments map a filter key (one of FILTER_ATTRIBUTES) to a list of regular
+        expressions matched against the corresponding attribute of each sample, or of the
+        resource it belongs to. Expressions use the RE2 syntax of OTTL's IsMatch.
+        If `include` is not empty, only the samples matching at least one of its expressions are
+        kept. Then, the samples matching any of the `exclude` expressions are dropped.
+
+        Raises:
+            ConfigError: if a filter key or regular expression is invalid.
+        """
+        conditions = {}
+        for kind, filters in (("include", include), ("exclude", exclude)):
+            matches = []
+            for key, patterns in filters.items():
+                if key not in FILTER_ATTRIBUTES:
+                    raise ConfigError(
+                        f"invalid {kind} filter key {key!r}; "
+                        f"expected one of {', '.join(sorted(FILTER_ATTRIBUTES))}"
+                    )
+                if not isinstance(patterns, list) or not all(
+                    isinstance(pattern, str) for pattern in patterns
+                ):
+                    raise ConfigError(f"{kind} filter {key!r} must be a list of strings")
+                for pattern in patterns:
+                    try:
+                        re.compile(pattern)
+                    except re.error as e:
+                        raise ConfigError(f"invalid {kind} filter {key!r} regex {pattern!r}: {e}")
+                    unsupported = _re2_unsupported(pattern)
+                    if unsupported:
+                        raise ConfigError(
+                            f"invalid {kind} filter {key!r} regex {pattern!r}: "
+                            f"{unsupported} not supported by RE2"
+                        )
+                    matches.append(f"IsMatch({FILTER_ATTRIBUTES[key]}, {_ottl_string(pattern)})")
+            conditions[kind] = matches
+
+        # the filter processor drops the samples matching any of its conditions
+        drop_conditions = list(conditions["exclude"])
+        if conditions["include"]:
+            drop_conditions.insert(0, f"not ({' or '.join(conditions['include'])})")
+        if not drop_conditions:
+            return
+
+        self.add_component(
+            Component.processor,
+            FILTER_PROCESSOR_NAME,
+            {"error_mode": "ignore", "profiles": {"sample": drop_conditions}},
+            pipelines=["profiles"],
+        )
+
+    def add_memory_limiter(self, limit_mib: int, spike_limit_mib: int):
+        """Cap the profiler's memory usage by refusing profiles when it grows too large.
+
+        The memory limiter is inserted as the first processor of the `profiles` pipeline, so
+        that profiles are refused before any other processor or exporter buffers them.
+
+        Args:
+            limit_mib: hard limit on the heap, in MiB.
+            spike_limit_mib: headroom below the hard limit at which the limiter starts refusing
+                data (the soft limit is `limit_mib - spike_limit_mib`).
+
+        Raises:
+            ConfigError: if any of the options is out of bounds.
+        """
+        if limit_mib < 1:
+            raise ConfigError(f"memory limit must be positive, got {limit_mib} MiB")
+        if not 0 < spike_limit_mib < limit_mib:
+            raise ConfigError(
+                f"memory spike limit must be positive and lower than the memory limit "
+                f"({limit_mib} MiB), got {spike_limit_mib} MiB"
+            )
+
+        self.add_component(
+            Component.processor,
+            MEMORY_LIMITER_PROCESSOR_NAME,
+            {
+                "check_interval": "1s",
+                "limit_mib": limit_mib,
+                "spike_limit_mib": spike_limit_mib,
+            },
+        )
+        self._add_to_pipeline(
+            MEMORY_LIMITER_PROCESSOR_NAME, Component.processor, ["profiles"], first=True
+        )
+
+    def add_batching(self, send_batch_size: int, send_batch_max_size: int, timeout: str):
+        """Batch profiles before they reach the exporters, to cut the number of export requests.
+
+        On build, the batch processor is added to each exporter's branch of the `profiles`
+        pipeline (`profiles/N`), so that each branch batches independently of the others. If
+        the pipeline isn't split into branches, or fails over between them, it's appended to the
+        `profiles` pipeline itself.
+
+        Args:
+            send_batch_size: number of profile samples after which a batch is sent.
+            send_batch_max_size: upper bound on the size of a batch; 0 means no limit.
+            timeout: time after which a batch is sent regardless of its size.
+
+        Raises:
+            ConfigError: if any of the options is out of bounds.
+        """
+        if send_batch_size < 1:
+            raise ConfigError(f"batch send size must be positive, got {send_batch_size}")
+        if send_batch_max_size and send_batch_max_size < send_batch_size:
+            raise ConfigError(
+                f"batch max size ({send_batch_max_size}) must be 0 (unlimited) "
+                f"or at least the batch send size ({send_batch_size})"
+            )
+        try:
+            seconds = parse_duration(timeout)
+        except ValueError as e:
+            raise ConfigError(f"batch timeout: {e}") from e
+        if seconds <= 0:
+            raise ConfigError(f"batch timeout must be positive, got {timeout!r}")
+
+        self.add_component(
+            Component.processor,
+            BATCH_PROCESSOR_NAME,
+            {
+                "send_batch_size": send_batch_size,
+                "send_batch_max_size": send_batch_max_size,
+                "timeout": timeout,
+            },
+        )
+
     def add_default_config(self):
         """Return the default config for OpenTelemetry Collector."""
         # The default config enables the profiling receiver, which is the ebpf profiler.
@@ -180,7 +656,28 @@ class ConfigBuilder:
         if pipelines:
             self._add_to_pipeline(name, component, pipelines)
 
-    def _add_to_pipeline(self, name: str, component: Component, pipelines: List[str]):
+    def add_connector(
+        self,
+        name: str,
+        config: Dict[str, Any],
+        from_pipelines: List[str],
+        to_pipelines: List[str],
+    ):
+        """Add a connector, linking the end of some pipelines to the start of others.
+
+        Args:
+            name: Unique identifier for this connector instance
+            config: Configuration dictionary for the connector
+            from_pipelines: Pipelines in which the connector acts as an exporter
+            to_pipelines: Pipelines in which the connector acts as a receiver
+        """
+        self._config[Component.connector.value][name] = config
+        self._add_to_pipeline(name, Component.exporter, from_pipelines)
+        self._add_to_pipeline(name, Component.receiver, to_pipelines)
+
+    def _add_to_pipeline(
+        self, name: str, component: Component, pipelines: List[str], first: bool = False
+    ):
         """Add a pipeline component to the service::pipelines config.
 
         Args:
@@ -188,6 +685,8 @@ class ConfigBuilder:
             component: Type of the component (receiver, processor, etc.)
             pipelines: List of pipeline types ('logs', 'metrics', 'traces') to add
                      the component to
+            first: Whether to insert the component at the head of the pipeline's components of
+                the same type, rather than appending it. Order matters for processors.
         """
         # Create the pipeline dict key chain if it doesn't exist
         for pipeline in pipelines:
@@ -202,7 +701,22 @@ class ConfigBuilder:
                 component.value,
                 [],
             ):
-                self._config["service"]["pipelines"][pipeline][component.value].append(name)
+                components = self._config["service"]["pipelines"][pipeline][component.value]
+                if first:
+                    components.insert(0, name)
+                else:
+                    components.append(name)
+
+    def _add_batching_to_pipelines(self):
+        """Add the batch processor, if any, at the end of each branch of the profiles pipeline."""
+        if BATCH_PROCESSOR_NAME not in self._config["processors"]:
+            return
+        branches = [
+            pipeline
+            for pipeline in self._config["service"]["pipelines"]
+            if pipeline.startswith("profiles/")
+        ]
+        self._add_to_pipeline(BATCH_PROCESSOR_NAME, Component.processor, branches or ["profiles"])
 
     def _add_missing_debug_exporters(self):
         """Add debug exporters to any pipeline that has no exporters.
@@ -233,6 +747,27 @@ class ConfigBuilder:
                 "insecure_skip_verify", insecure_skip_verify
             )
 
+    def _add_exporter_settings(self):
+        """Add the common exporter settings to every exporter's config.
+
+        Settings already present in an exporter's config are not updated.
+        """
+        for exporter in self._config.get("exporters", {}):
+            if exporter.split("/")[0] == "debug":
+                continue
+            for key, value in self._exporter_settings.items():
+                self._config["exporters"][exporter].setdefault(key, copy.deepcopy(value))
+
+    def _add_config_generation(self, generation: str):
+        """Tag the profiler's own telemetry with the generation of the config it's running with.
+
+        The profiler reports it on its metrics endpoint, so that after a reload we can tell
+        whether it's running the new config or kept the old one.
+        """
+        if generation:
+            resource = self._config["service"]["telemetry"].setdefault("resource", {})
+            resource[CONFIG_GENERATION_ATTRIBUTE] = generation
+
     def _add_telemetry(self, category: Literal["logs", "metrics", "traces"], telem_config: Dict):
         """Add internal telemetry to the config.
 
@@ -2,17 +2,52 @@
 
 import logging
 from collections import namedtuple
-from typing import List, Dict
+from enum import Enum, unique
+from typing import Any, List, Dict
 from constants import CA_CERT_PATH
 
+import yaml
 
-from config_builder import Component, ConfigBuilder
+
+from config_builder import Component, ConfigBuilder, ConfigError, sha256
 from charms.pyroscope_coordinator_k8s.v0.profiling import Endpoint
 
 logger = logging.getLogger(__name__)
 
+FORWARD_CONNECTOR_NAME = "forward/profiling"
+
 Config = namedtuple("Config", "config, hash")
 
+# share of the host's RAM the profiler may use by default, and bounds for it
+DEFAULT_MEMORY_LIMIT_PERCENTAGE = 10
+MIN_DEFAULT_MEMORY_LIMIT_MIB = 256
+MAX_DEFAULT_MEMORY_LIMIT_MIB = 2048
+# the collector docs recommend a spike limit of about 20% of the hard limit
+DEFAULT_MEMORY_SPIKE_LIMIT_PERCENTAGE = 20
+
+
+@unique
+class ExportMode(str, Enum):
+    """How profiles are distributed across the related profiling backends.
+
+    Attributes:
+        broadcast: every profile is sent to every backend.
+        load_balance: each profiler sends all of its profiles to a single backend, picked by
+            consistent hashing of the host, so that the hosts are spread across the backends.
+    """
+
+    broadcast = "broadcast"
+    load_balance = "load-balance"
+
+
+def pick_endpoint(endpoints: List[Endpoint], key: str) -> Endpoint:
+    """Pick one of the endpoints for `key`, using rendezvous (highest random weight) hashing.
+
+    Each key consistently maps to the same endpoint; when an endpoint is added or removed,
+    only the keys mapping to it (about 1/N of them) move to a different endpoint.
+    """
+    return max(endpoints, key=lambda endpoint: sha256(f"{key}/{endpoint.otlp_grpc}"))
+
 
 class ConfigManager:
     """Configuration manager for OpenTelemetry Collector."""
@@ -33,32 +68,160 @@ class ConfigManager:
             exporter_skip_verify=insecure_skip_verify,
         )
 
-    def build(self) -> Config:
-        """Return the built config and its hash."""
-        cfg = self._config.build()
+    def build(self, generation: str = "") -> Config:
+        """Return the built config, tagged with `generation` if any, and its hash."""
+        cfg = self._config.build(generation)
         return Config(cfg, self._config.hash(cfg))
 
+    def configure_profiling_receiver(
+        self,
+        samples_per_second: int,
+        reporter_interval: str,
+        probabilistic_threshold: int,
+        probabilistic_interval: str,
+        tracers: str,
+        off_cpu_threshold: float = 0.0,
+    ):
+        """Tune the eBPF profiling receiver; may raise ConfigError on invalid options."""
+        self._config.configure_profiling_receiver(
+            samples_per_second=samples_per_second,
+            reporter_interval=reporter_interval,
+            probabilistic_threshold=probabilistic_threshold,
+            probabilistic_interval=probabilistic_interval,
+            tracers=tracers,
+            off_cpu_threshold=off_cpu_threshold,
+        )
+
+    def set_exporter_compression(self, compression: str):
+        """Compress exported profiles; may raise ConfigError on invalid options."""
+        self._config.set_exporter_compression(compression)
+
+    def configure_exporter_retry(
+        self,
+        initial_interval: str,
+        max_interval: str,
+        max_elapsed_time: str,
+        timeout: str,
+    ):
+        """Configure the exporters' retries and timeout; may raise ConfigError on invalid options."""
+        self._config.configure_exporter_retry(
+            initial_interval=initial_interval,
+            max_interval=max_interval,
+            max_elapsed_time=max_elapsed_time,
+            timeout=timeout,
+        )
+
+    def configure_sending_queue(self, queue_size: int, num_consumers: int, storage_directory: str):
+        """Configure the exporters' (persistent) queue; may raise ConfigError on invalid options."""
+        self._config.configure_sending_queue(
+            queue_size=queue_size,
+            num_consumers=num_consumers,
+            storage_directory=storage_directory,
+        )
+
+    def add_memory_limiter(self, limit_mib: int, spike_limit_mib: int, host_memory_mib: int):
+        """Cap the profiler's memory; may raise ConfigError on invalid options.
+
+        A limit of 0 means: derive it from the host's total memory. A spike limit of 0 means:
+        derive it from the (possibly derived) limit.
+        """
+        if not limit_mib:
+            limit_mib = host_memory_mib * DEFAULT_MEMORY_LIMIT_PERCENTAGE // 100
+            limit_mib = max(
+                MIN_DEFAULT_MEMORY_LIMIT_MIB, min(limit_mib, MAX_DEFAULT_MEMORY_LIMIT_MIB)
+            )
+        if not spike_limit_mib:
+            spike_limit_mib = limit_mib * DEFAULT_MEMORY_SPIKE_LIMIT_PERCENTAGE // 100
+        self._config.add_memory_limiter(limit_mib=limit_mib, spike_limit_mib=spike_limit_mib)
+
+    def add_profile_filter(self, include: str, exclude: str):
+        """Drop unwanted profiles before export; may raise ConfigError on invalid options.
+
+        Both arguments are YAML mappings from a filter key (e.g. `process_name`) to a list of
+        regular expressions, as set in the charm config.
+        """
+        self._config.add_profile_filter(
+            include=self._parse_filter("include", include),
+            exclude=self._parse_filter("exclude", exclude),
+        )
+
+    @staticmethod
+    def _parse_filter(kind: str, raw: str) -> Dict[str, Any]:
+        try:
+            parsed = yaml.safe_load(raw) if raw.strip() else {}
+        except yaml.YAMLError as e:
+            raise ConfigError(f"{kind} filter is not valid YAML: {e}")
+        if not isinstance(parsed, dict):
+            raise ConfigError(f"{kind} filter must be a mapping of filter keys to regex lists")
+        return parsed
+
+    def add_batching(self, send_batch_size: int, send_batch_max_size: int, timeout: str):
+        """Batch profiles before export; may raise ConfigError on invalid options."""
+        self._config.add_batching(
+            send_batch_size=send_batch_size,
+            send_batch_max_size=send_batch_max_size,
+            timeout=timeout,
+        )
+
     def add_topology_labels(self, topology_labels: Dict[str, str]):
         """Inject juju topology labels on the profile pipeline."""
         self._config.inject_topology_labels(topology_labels)
 
-    def add_profile_forwarding(self, endpoints: List[Endpoint]):
-        """Configure forwarding profiles to a profiling backend (Pyroscope, Otelcol)."""
+    def add_profile_forwarding(
+        self,
+        endpoints: List[Endpoint],
+        mode: str = ExportMode.broadcast.value,
+        routing_key: str = "",
+    ):
+        """Configure forwarding profiles to a profiling backend (Pyroscope, Otelcol).
+
+        Args:
+            endpoints: the profiling backends' ingestion endpoints.
+            mode: one of the ExportMode values.
+            routing_key: identity of this host, used to pick a backend in load-balance mode.
+
+        Raises:
+            ConfigError: if the export mode is invalid.
+        """
+        try:
+            export_mode = ExportMode(mode)
+        except ValueError as e:
+            raise ConfigError(
+                f"invalid export mode {mode!r}; "
+                f"expected one of {', '.join(m.value for m in ExportMode)}"
+            ) from e
+
+        if export_mode is ExportMode.load_balance and endpoints:
+            endpoints = [pick_endpoint(endpoints, routing_key)]
+
+        # each exporter gets its own branch of the pipeline, so that a slow or unreachable
+        # backend only applies backpressure to its own branch
+        pipelines = [f"profiles/{idx}" for idx in range(len(endpoints))]
         for idx, endpoint in enumerate(endpoints):
+            config = {
+                "endpoint": endpoint.otlp_grpc,
+                # we need `insecure` as well as `insecure_skip_verify` because the endpoint
+                # we're receiving from pyroscope/otelcol is a grpc one and has no scheme prefix, and
+                # the client defaults to https unless we set `insecure=False`.
+                "tls": {
+                    "insecure": endpoint.insecure,
+                    "insecure_skip_verify": self._insecure_skip_verify,
+                    **({"ca_file": str(CA_CERT_PATH)} if CA_CERT_PATH.exists() else {}),
+                },
+            }
             self._config.add_component(
                 Component.exporter,
                 # first component of this ID is the exporter type
                 f"otlp/profiling/{idx}",
-                {
-                    "endpoint": endpoint.otlp_grpc,
-                    # we need `insecure` as well as `insecure_skip_verify` because the endpoint
-                    # we're receiving from pyroscope/otelcol is a grpc one and has no scheme prefix, and
-                    # the client defaults to https unless we set `insecure=False`.
-                    "tls": {
-                        "insecure": endpoint.insecure,
-                        "insecure_skip_verify": self._insecure_skip_verify,
-                        **({"ca_file": str(CA_CERT_PATH)} if CA_CERT_PATH.exists() else {}),
-                    },
-                },
-                pipelines=["profiles"],
+                config,
+                pipelines=[pipelines[idx]],
             )
+
+        if not endpoints:
+            return
+        self._config.add_connector(
+            FORWARD_CONNECTOR_NAME,
+            {},
+            from_pipelines=["profiles"],
+            to_pipelines=pipelines,
+        )
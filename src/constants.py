@@ -5,3 +5,4 @@ from pathlib import Path
 
 MACHINE_LOCK_PATH: Final[Path] = Path("/etc/otel-ebpf-profiler/machine.lock")
 CA_CERT_PATH: Final[Path] = Path("/etc/otel-ebpf-profiler/receive-ca-cert.crt")
+HOST_CAPABILITIES_PATH: Final[Path] = Path("/etc/otel-ebpf-profiler/host-capabilities.json")
@@ -0,0 +1,145 @@
+"""Probe what this host can do, eBPF-wise, and cache the result on disk.
+
+None of these properties can change without a reboot, so we probe them once per boot and
+answer all later status evaluations from the cache, without forking any process.
+"""
+
+import dataclasses
+import json
+import logging
+import os
+import platform
+import subprocess
+from pathlib import Path
+from typing import Final, FrozenSet, Optional, Tuple
+
+from constants import HOST_CAPABILITIES_PATH
+
+logger = logging.getLogger(__name__)
+
+BOOT_ID_PATH: Final[Path] = Path("/proc/sys/kernel/random/boot_id")
+BTF_PATH: Final[Path] = Path("/sys/kernel/btf/vmlinux")
+
+# virtualization types reported by `systemd-detect-virt` for containers, which share the host
+# kernel and can't load eBPF programs (unless privileged, which juju doesn't do)
+CONTAINER_VIRT_TYPES: Final[FrozenSet[str]] = frozenset(
+    {
+        "lxc",
+        "lxc-libvirt",
+        "docker",
+        "podman",
+        "rkt",
+        "systemd-nspawn",
+        "openvz",
+        "wsl",
+        "proot",
+        "pouch",
+    }
+)
+
+# minimum kernel versions supported by the otel eBPF profiler
+_MIN_KERNEL_VERSION: Final = {"arm64": (5, 5)}
+_DEFAULT_MIN_KERNEL_VERSION: Final = (4, 19)
+
+_capabilities: Optional["HostCapabilities"] = None
+
+
+@dataclasses.dataclass(frozen=True)
+class HostCapabilities:
+    """Capabilities of the host machine relevant to eBPF profiling."""
+
+    boot_id: str
+    """Boot the capabilities were probed in; the cache is invalidated on reboot."""
+    virt_type: str
+    """Virtualization type, as reported by `systemd-detect-virt` (e.g. 'kvm', 'lxc', 'none')."""
+    kernel_release: str
+    """Running kernel release, e.g. '6.8.0-45-generic'."""
+    btf_available: bool
+    """Whether the kernel exposes BTF type information."""
+    ebpf_supported: bool
+    """Whether the profiler can load its eBPF programs on this host."""
+
+    @property
+    def in_container(self) -> bool:
+        """Whether this unit runs in a container rather than on a VM or bare metal."""
+        return self.virt_type in CONTAINER_VIRT_TYPES
+
+    @property
+    def kernel_version(self) -> Tuple[int, ...]:
+        """Major and minor version of the running kernel."""
+        return _parse_kernel_version(self.kernel_release)
+
+
+def _parse_kernel_version(release: str) -> Tuple[int, ...]:
+    """Parse '6.8.0-45-generic' into (6, 8)."""
+    version = []
+    for part in release.split("-")[0].split(".")[:2]:
+        if not part.isdigit():
+            break
+        version.append(int(part))
+    return tuple(version)
+
+
+def _min_kernel_version() -> Tuple[int, int]:
+    arch = "arm64" if platform.machine().lower() in ("aarch64", "arm64") else "amd64"
+    return _MIN_KERNEL_VERSION.get(arch, _DEFAULT_MIN_KERNEL_VERSION)
+
+
+def _boot_id() -> str:
+    return BOOT_ID_PATH.read_text().strip() if BOOT_ID_PATH.exists() else ""
+
+
+def _probe(boot_id: str) -> HostCapabilities:
+    """Probe the host capabilities; this forks `systemd-detect-virt`."""
+    virt_type = subprocess.getoutput("systemd-detect-virt").strip()
+    kernel_release = platform.release()
+    in_container = virt_type in CONTAINER_VIRT_TYPES
+    return HostCapabilities(
+        boot_id=boot_id,
+        virt_type=virt_type,
+        kernel_release=kernel_release,
+        btf_available=BTF_PATH.exists(),
+        ebpf_supported=not in_container
+        and _parse_kernel_version(kernel_release) >= _min_kernel_version(),
+    )
+
+
+def _load(boot_id: str) -> Optional[HostCapabilities]:
+    """Load the cached capabilities, if they were probed in the current boot."""
+    if not HOST_CAPABILITIES_PATH.exists():
+        return None
+    try:
+        capabilities = HostCapabilities(**json.loads(HOST_CAPABILITIES_PATH.read_text()))
+    except (ValueError, TypeError):
+        logger.debug("invalid host capabilities cache; probing again")
+        return None
+    return capabilities if capabilities.boot_id == boot_id else None
+
+
+def get_host_capabilities() -> HostCapabilities:
+    """Return the host capabilities, probing them only if not cached for the current boot."""
+    global _capabilities
+    boot_id = _boot_id()
+    if _capabilities is None or _capabilities.boot_id != boot_id:
+        _capabilities = _load(boot_id)
+    if _capabilities is None:
+        _capabilities = _probe(boot_id)
+        logger.info("probed host capabilities: %s", _capabilities)
+        HOST_CAPABILITIES_PATH.parent.mkdir(parents=True, exist_ok=True)
+        HOST_CAPABILITIES_PATH.write_text(json.dumps(dataclasses.asdict(_capabilities)))
+    return _capabilities
+
+
+def total_memory_mib() -> int:
+    """Return the total physical memory of the host, in MiB.
+
+    Unlike the other capabilities this isn't cached, as memory can be hot-plugged.
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+
+
+def clear_cache():
+    """Remove the cached host capabilities."""
+    global _capabilities
+    _capabilities = None
+    HOST_CAPABILITIES_PATH.unlink(missing_ok=True)
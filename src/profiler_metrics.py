@@ -0,0 +1,102 @@
+"""Read the profiler's self-monitoring metrics from its Prometheus endpoint."""
+
+import logging
+import re
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, NamedTuple, Optional
+
+from config_builder import Port
+
+logger = logging.getLogger(__name__)
+
+METRICS_URL = f"http://localhost:{int(Port.metrics)}/metrics"
+# the CONFIG_GENERATION_ATTRIBUTE resource attribute, as exposed on the `target_info` metric
+CONFIG_GENERATION_LABEL = "charm_config_generation"
+
+_SAMPLE_RE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)")
+_LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+class Sample(NamedTuple):
+    """A single sample of a Prometheus metric."""
+
+    name: str
+    labels: Dict[str, str]
+    value: float
+
+
+def parse(text: str) -> List[Sample]:
+    """Parse the Prometheus text exposition format; comments and malformed lines are skipped."""
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = _SAMPLE_RE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        try:
+            samples.append(Sample(name, dict(_LABEL_RE.findall(labels or "")), float(value)))
+        except ValueError:
+            continue
+    return samples
+
+
+def scrape(timeout: float = 0.5) -> Optional[List[Sample]]:
+    """Scrape the profiler's metrics endpoint; return None if it's unreachable."""
+    try:
+        with urllib.request.urlopen(METRICS_URL, timeout=timeout) as response:  # noqa: S310
+            return parse(response.read().decode())
+    except (urllib.error.URLError, OSError) as e:
+        logger.debug("unable to scrape %s: %s", METRICS_URL, e)
+        return None
+
+
+def total(samples: List[Sample], name_prefix: str, **labels: str) -> float:
+    """Sum the values of all samples whose name starts with `name_prefix` and match `labels`."""
+    return sum(
+        sample.value
+        for sample in samples
+        if sample.name.startswith(name_prefix)
+        and all(sample.labels.get(key) == value for key, value in labels.items())
+    )
+
+
+def processor_dropped_items(samples: List[Sample], processor: str, signal: str) -> float:
+    """Return how many items of `signal` a processor took in, but didn't pass on.
+
+    The collector reports the items going in and out of each processor for every signal,
+    profiles included; unlike the `otelcol_processor_refused_*` counters, which only cover
+    spans, metric points and log records.
+    """
+    labels = {"processor": processor, "otel_signal": signal}
+    incoming = total(samples, "otelcol_processor_incoming_items", **labels)
+    outgoing = total(samples, "otelcol_processor_outgoing_items", **labels)
+    return max(0.0, incoming - outgoing)
+
+
+def config_generation(samples: List[Sample]) -> Optional[str]:
+    """Return the generation of the config the profiler is running with, if it reports one."""
+    for sample in samples:
+        if sample.name == "target_info" and CONFIG_GENERATION_LABEL in sample.labels:
+            return sample.labels[CONFIG_GENERATION_LABEL]
+    return None
+
+
+def wait_for_config_generation(
+    generation: str, timeout: float, interval: float = 0.2
+) -> Optional[float]:
+    """Wait for the profiler to report running the config `generation`.
+
+    Return how long it took, in seconds, or None if it didn't within `timeout` seconds.
+    """
+    start = time.monotonic()
+    while True:
+        samples = scrape()
+        if samples and config_generation(samples) == generation:
+            return time.monotonic() - start
+        if time.monotonic() - start >= timeout:
+            return None
+        time.sleep(interval)
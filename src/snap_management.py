@@ -6,19 +6,53 @@ Modified from https://github.com/canonical/k8s-operator/blob/main/charms/worker/
 """
 
 import logging
+import os
 import platform
 import shlex
 import subprocess
+import tempfile
+import time
 from pathlib import Path
-from typing import Dict, Optional, Set, Final
-
-from charms.operator_libs_linux.v2.snap import JSONAble, SnapCache, SnapState
+from typing import Any, Dict, NamedTuple, Optional, Set, Final
+
+from charms.operator_libs_linux.v2.snap import Error as SnapdError
+from charms.operator_libs_linux.v2.snap import (
+    JSONAble,
+    Snap,
+    SnapAPIError,
+    SnapNotFoundError,
+    SnapState,
+)
+from config_builder import sha256
+from host_capabilities import clear_cache as clear_host_capabilities_cache
+from host_capabilities import get_host_capabilities
+from snapd_client import SnapdClient
 
 logger = logging.getLogger(__name__)
 
 CONFIG_PATH: Final[Path] = Path("/etc/otel-ebpf-profiler/config.yaml")
+# the config file's first line records the hash (sha256) of the config that follows, so that the
+# two can only ever be replaced together, and that edits by hand can be detected
+CONFIG_HASH_HEADER: Final[str] = "# config-hash: "
+# where older charm revisions kept the config hash, in a file of its own
 HASH_LOCK_PATH: Final[Path] = Path("/opt/otel_ebpf_profiler_reload")
 
+# Each hook is dispatched in a fresh process, so this module-level cache lives for exactly one
+# dispatch. It is populated lazily and dropped by `invalidate_snap_state` after any operation
+# that mutates the snap.
+_snap_cache: Optional[Dict[str, Snap]] = None
+# ... and so does the snapd client, so that all the dispatch's snapd requests share its
+# keep-alive connections.
+_snapd_client: Optional[SnapdClient] = None
+
+# systemd ActiveStates that a unit only passes through on its way to a stable one
+_TRANSIENT_ACTIVE_STATES: Final[Set[str]] = {
+    "activating",
+    "deactivating",
+    "reloading",
+    "refreshing",
+}
+
 
 def get_system_arch() -> str:
     """Returns the architecture of this machine, mapping some values to amd64 or arm64.
@@ -64,6 +98,58 @@ class SnapMap:
         return set(SnapMap.snap_maps.keys())
 
 
+def get_snapd_client() -> SnapdClient:
+    """Return the snapd client shared by all the snapd requests of this hook dispatch."""
+    global _snapd_client
+    if _snapd_client is None:
+        _snapd_client = SnapdClient()
+    return _snapd_client
+
+
+def _snap(info: Dict[str, Any], state: SnapState, apps: Optional[list] = None) -> Snap:
+    """Build a Snap from the snapd API's description of it, like SnapCache does."""
+    return Snap(
+        name=info["name"],
+        state=state,
+        channel=info["channel"],
+        revision=info["revision"],
+        confinement=info["confinement"],
+        apps=apps,
+        version=info.get("version"),
+    )
+
+
+def get_snap(snap_name: str) -> Snap:
+    """Return the snap object, loading the snapd state only once per hook dispatch.
+
+    Like a SnapCache, this queries the snapd API for all installed snaps, so we share the
+    result across all lookups; unlike it, the queries go through the shared snapd client.
+
+    Raises:
+        SnapNotFoundError: if snapd doesn't know the snap.
+    """
+    global _snap_cache
+    client = get_snapd_client()
+    if _snap_cache is None:
+        _snap_cache = {
+            info["name"]: _snap(info, SnapState.Latest, apps=info.get("apps"))
+            for info in client.get_installed_snaps()
+        }
+    if snap_name not in _snap_cache:
+        try:
+            info = client.get_snap_information(snap_name)
+        except SnapAPIError as e:
+            raise SnapNotFoundError(f"Snap '{snap_name}' not found!") from e
+        _snap_cache[snap_name] = _snap(info, SnapState.Available)
+    return _snap_cache[snap_name]
+
+
+def invalidate_snap_state() -> None:
+    """Drop the cached snapd state; call this after any operation that mutates a snap."""
+    global _snap_cache
+    _snap_cache = None
+
+
 class SnapSpecError(Exception):
     """Raised when there's an error with the snap specification.
 
@@ -102,7 +188,7 @@ def install_snap(
     This function installs the specified snap, configures it according to the
     provided parameters, and pins it to prevent automatic updates. The revision
     is determined based on the system architecture and requested confinement mode,
-    as defined in the SnapMap.
+    as defined in the SnapMap. All operations go through the snapd API.
 
     Args:
         snap_name: Name of the snap to install (e.g., 'opentelemetry-collector')
@@ -113,7 +199,6 @@ def install_snap(
     Raises:
         SnapSpecError: If the snap or revision is not found in the SnapMap
         SnapInstallError: If there's an error during installation or configuration
-        snap.SnapError: For errors from the underlying snap management library
     """
     # Check whether we have a spec in the SnapMap
     try:
@@ -126,42 +211,149 @@ def install_snap(
         ) from e
 
     # Install the Snap
-    cache = SnapCache()
-    snap = cache[snap_name]
-    snap.ensure(state=SnapState.Present, revision=str(revision), classic=classic)
-    logger.info(
-        f"{snap_name} snap has been installed at revision={revision}"
-        f" with confinement={'classic' if classic else 'strict'}"
-    )
-    if config:
-        snap.set(config)
-    snap.hold()
+    snap = get_snap(snap_name)
+    client = get_snapd_client()
+    try:
+        if not snap.present:
+            client.install(snap_name, revision=str(revision), classic=classic)
+        elif snap.revision != str(revision):
+            client.refresh(snap_name, revision=str(revision), classic=classic)
+        logger.info(
+            f"{snap_name} snap has been installed at revision={revision}"
+            f" with confinement={'classic' if classic else 'strict'}"
+        )
+        if config:
+            client.set_config(snap_name, config)
+        client.hold(snap_name)
+    except SnapdError as e:
+        raise SnapInstallError(f"Failed to install snap {snap_name}") from e
+    finally:
+        invalidate_snap_state()
+
+
+def start_snap(snap_name: str, enable: bool = False) -> None:
+    """Start all the snap's services through the snapd API.
+
+    Raises:
+        SnapServiceError: if snapd failed to start them.
+    """
+    try:
+        get_snapd_client().start(snap_name, enable=enable)
+    except SnapdError as e:
+        raise SnapServiceError(f"Failed to start {snap_name}") from e
+    finally:
+        invalidate_snap_state()
 
 
 def cleanup_config():
-    """Remove config file and hash lockfile."""
+    """Remove config file, leftover temporary files and cached host capabilities."""
     logger.info("Cleaning up snap config")
     CONFIG_PATH.unlink(missing_ok=True)
+    _remove_stale_temp_files(CONFIG_PATH)
     HASH_LOCK_PATH.unlink(missing_ok=True)
+    clear_host_capabilities_cache()
+
+
+def _remove_stale_temp_files(path: Path):
+    """Remove the temporary files an interrupted `_atomic_write` to `path` left behind."""
+    if path.parent.is_dir():
+        for tmp in path.parent.glob(f".{path.name}.*.tmp"):
+            tmp.unlink(missing_ok=True)
+
+
+def _atomic_write(path: Path, content: str):
+    """Replace the file at `path` so that readers, and a crash, only see its old or new content.
+
+    The content is written to a temporary file in the same directory and fsynced, then renamed
+    over `path`; the directory is fsynced last, so that the rename itself is durable.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fchmod(f.fileno(), 0o644)
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    dir_fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class ConfigSignature(NamedTuple):
+    """Identifies a config file whose content we've verified, so it needn't be read again."""
+
+    inode: int
+    size: int
+    mtime_ns: int
+    hash: str
+
+
+def config_signature(hash: str) -> Optional[ConfigSignature]:
+    """Return the signature of the config file, as currently on disk, if it has `hash`.
+
+    The caller must know the file's content matches `hash`, e.g. right after `update_config`.
+    """
+    try:
+        stat = CONFIG_PATH.stat()
+    except FileNotFoundError:
+        return None
+    return ConfigSignature(stat.st_ino, stat.st_size, stat.st_mtime_ns, hash)
+
+
+def _read_config_hash() -> str:
+    """Return the hash of the config file's content, or "" if it's missing or was tampered with.
+
+    The content must match the hash recorded in the file's header: anything else means that
+    the file was edited (or truncated) behind the charm's back.
+    """
+    try:
+        content = CONFIG_PATH.read_text()
+    except FileNotFoundError:
+        return ""
+    header, _, config = content.partition("\n")
+    if not header.startswith(CONFIG_HASH_HEADER) and HASH_LOCK_PATH.exists():
+        # written by an older charm revision, which kept the hash in a separate file
+        return ""
+    recorded_hash = header[len(CONFIG_HASH_HEADER) :].strip()
+    if not header.startswith(CONFIG_HASH_HEADER) or recorded_hash != sha256(config):
+        logger.warning("%s was modified outside of the charm; restoring it", CONFIG_PATH)
+        return ""
+    return recorded_hash
 
 
 def _write_config(config: str, hash: str):
-    """Write config file and its hash."""
+    """Atomically replace the config file, along with its hash."""
     logger.info("Updating snap config")
+    # a hook that crashed mid-write may have left a temporary file behind
+    _remove_stale_temp_files(CONFIG_PATH)
+    _atomic_write(CONFIG_PATH, f"{CONFIG_HASH_HEADER}{hash}\n{config}")
+    # the hash now lives in the config file
+    HASH_LOCK_PATH.unlink(missing_ok=True)
 
-    CONFIG_PATH.parent.mkdir(parents=True, exist_ok=True)
-    CONFIG_PATH.write_text(config)
-
-    HASH_LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
-    HASH_LOCK_PATH.write_text(hash)
 
+def update_config(
+    new_config: str, new_hash: str, verified: Optional[ConfigSignature] = None
+) -> bool:
+    """Check whether the config on disk differs from `new_config`; if so update it.
 
-def update_config(new_config: str, new_hash: str) -> bool:
-    """Check whether the config has changed; if so update it on disk."""
-    old_hash = ""
-    if HASH_LOCK_PATH.exists():
-        old_hash = HASH_LOCK_PATH.read_text()
-    if new_hash != old_hash:
+    Args:
+        new_config: the config to write.
+        new_hash: the sha256 hash of `new_config`.
+        verified: the signature of the config file as we last left it, if known; if the file
+            still has that signature and hash, it's not read.
+    """
+    if verified and verified.hash == new_hash and config_signature(new_hash) == verified:
+        return False
+    if verified and not CONFIG_PATH.exists():
+        logger.warning("%s was deleted outside of the charm; restoring it", CONFIG_PATH)
+    if new_hash != _read_config_hash():
         _write_config(new_config, new_hash)
         return True
     return False
@@ -175,25 +367,102 @@ def reload(snap_name: str, service_name: str):
     cmd = f"sudo systemctl kill -s SIGHUP snap.{snap_name}.{service_name}.service"
     logger.info("SIGHUPping %s.%s with '%s'", snap_name, service_name, cmd)
     try:
-        subprocess.run(shlex.split(cmd))
+        subprocess.run(shlex.split(cmd), check=True)
     except subprocess.CalledProcessError:
         logger.error("error running: '%s'", cmd)
         raise ConfigReloadError("error reloading config")
+    finally:
+        invalidate_snap_state()
+
+
+def schedule_reload(snap_name: str, service_name: str, delay: float) -> bool:
+    """Schedule a SIGHUP to the snap service in `delay` seconds, unless one is already scheduled.
+
+    The SIGHUP is sent by a transient systemd timer, so all the config changes made until it
+    fires are picked up by a single reload. Return whether a reload was scheduled by this call.
+    On failure, may raise ConfigReloadError.
+    """
+    timer = f"{snap_name}-reload"
+    if _systemctl_show(f"{timer}.timer").get("ActiveState") == "active":
+        logger.info("a reload of %s.%s is already scheduled", snap_name, service_name)
+        return False
+
+    cmd = [
+        "sudo",
+        "systemd-run",
+        f"--unit={timer}",
+        f"--on-active={delay:g}s",
+        "--timer-property=AccuracySec=100ms",
+        # unload the timer once it fired, so that the next reload can be scheduled
+        "--timer-property=RemainAfterElapse=no",
+        "--collect",
+        "systemctl",
+        "kill",
+        "-s",
+        "SIGHUP",
+        f"snap.{snap_name}.{service_name}.service",
+    ]
+    logger.info("scheduling a reload of %s.%s in %gs", snap_name, service_name, delay)
+    try:
+        subprocess.run(cmd, check=True)
+    except subprocess.CalledProcessError:
+        logger.error("error running: '%s'", shlex.join(cmd))
+        raise ConfigReloadError("error scheduling config reload")
+    return True
+
+
+class ServiceState(NamedTuple):
+    """State of a snap service, as reported by its systemd unit."""
+
+    load_state: str
+    """systemd LoadState, e.g. 'loaded' or 'not-found' if the snap isn't installed."""
+    active_state: str
+    """systemd ActiveState, e.g. 'active', 'inactive', 'failed' or 'activating'."""
+
+
+def _systemctl_show(unit: str) -> Dict[str, str]:
+    """Query the load and activation state of a systemd unit."""
+    output = subprocess.run(
+        ["systemctl", "show", unit, "--property=LoadState,ActiveState"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
+
+
+def service_state(snap_name: str, service_name: str, timeout: float = 0.5) -> ServiceState:
+    """Return the state of the snap service's systemd unit.
+
+    This reads the unit properties directly instead of going through snapd. If the unit is
+    transitioning (e.g. it has just been started or SIGHUPped), wait up to `timeout` seconds for
+    it to settle, so that early startup failures are caught; otherwise return immediately.
+    """
+    unit = f"snap.{snap_name}.{service_name}.service"
+    deadline = time.monotonic() + timeout
+    while True:
+        props = _systemctl_show(unit)
+        state = ServiceState(
+            load_state=props.get("LoadState", ""),
+            active_state=props.get("ActiveState", ""),
+        )
+        if state.active_state not in _TRANSIENT_ACTIVE_STATES or time.monotonic() >= deadline:
+            return state
+        time.sleep(0.05)
 
 
 def check_status(snap_name: str, service_name: str) -> Optional[str]:
     """Verify the status of the snap/service, return an error message or nothing if everything is OK."""
-    snap = SnapCache()[snap_name]
+    state = service_state(snap_name, service_name)
 
-    if snap.state is SnapState.Absent:
+    if state.load_state == "not-found":
         return f"{snap_name!r} snap is not installed. Check juju logs for any errors during installation."
 
-    service = snap.services[service_name]
-    if not service["active"]:
+    if state.active_state != "active":
         # common error scenario if the service isn't running: the user deployed to a machine
         # without the right constraints
-        virt_type = subprocess.getoutput("systemd-detect-virt")
-        if virt_type == "lxc":
+        capabilities = get_host_capabilities()
+        if capabilities.in_container:
             logger.error(
                 "It looks like you deployed this application to a host without the right capabilities. "
                 "To confirm: run `juju constraints <this-app-name>` and verify that "
@@ -201,6 +470,12 @@ def check_status(snap_name: str, service_name: str) -> Optional[str]:
                 "and you need to redeploy using the right `--constraints`."
             )
             return "Snap error on startup: check host machine capabilities (virt-type). See juju logs for more."
+        if not capabilities.ebpf_supported:
+            logger.error(
+                "The running kernel (%s) is too old to be instrumented with eBPF.",
+                capabilities.kernel_release,
+            )
+            return "Snap error on startup: check host machine capabilities (kernel). See juju logs for more."
 
         return f"The otel-ebpf-profiler snap is not running. Check `sudo snap logs {snap_name}` for errors."
 
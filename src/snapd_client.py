@@ -0,0 +1,328 @@
+"""Drive snapd through its REST API, rather than by forking the `snap` CLI.
+
+Every `snap` CLI call forks a process and waits for the CLI to start up, only for it to talk to
+snapd over the very same unix socket; the operations the charm runs on install and upgrade go
+straight to the snapd API instead, over connections that are kept open from one request to the
+next.
+"""
+
+import http.client
+import json
+import logging
+import select
+import socket
+import time
+import urllib.parse
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import opentelemetry.trace
+from charms.operator_libs_linux.v2.snap import (
+    JSONAble,
+    JSONType,
+    SnapAPIError,
+    SnapClient,
+    SnapError,
+)
+
+logger = logging.getLogger(__name__)
+tracer = opentelemetry.trace.get_tracer(__name__)
+
+# change polling backoff: the first poll comes as quickly as the `snap` CLI's, but a long change
+# (e.g. downloading a snap) is polled less and less often
+POLL_INITIAL_INTERVAL = 0.1
+POLL_BACKOFF_FACTOR = 2.0
+POLL_MAX_INTERVAL = 2.0
+# idle keep-alive connections to snapd a client holds on to, for its next requests
+POOL_SIZE = 2
+
+# how a connection snapd closed fails, depending on how far the request got
+_RESET_ERRORS = (BrokenPipeError, ConnectionResetError)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket."""
+
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        """Connect to the unix socket, instead of a TCP address."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class _ConnectionPool:
+    """Keep-alive HTTP/1.1 connections to a unix socket, reused across requests.
+
+    The base client's opener connects anew for every request; snapd keeps connections open, so
+    a request can go out on the connection the previous one was served on instead.
+    """
+
+    def __init__(self, socket_path: str, timeout: float, size: int = POOL_SIZE):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.size = size
+        self._idle: List[_UnixHTTPConnection] = []
+
+    def request(
+        self, method: str, url: str, body: Optional[bytes], headers: Dict[str, str]
+    ) -> Tuple[int, str, bytes]:
+        """Send a request; return the response's status, reason and body.
+
+        snapd may close an idle connection at any time, in which case reusing it fails with EPIPE
+        or ECONNRESET, or gets no response at all; the request is then retried once, on a new
+        connection, as long as snapd can't have acted on it: it didn't reach snapd, snapd closed
+        the connection without answering, or it's a GET.
+        """
+        connection, reused = self._acquire()
+        while True:
+            sent = False
+            try:
+                connection.request(method, url, body=body, headers=headers)
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+            except _RESET_ERRORS as e:
+                connection.close()
+                unanswered = isinstance(e, http.client.RemoteDisconnected)
+                if not reused or (sent and not unanswered and method != "GET"):
+                    raise
+                logger.debug("snapd closed an idle connection (%s), reconnecting", e)
+                connection, reused = self._connect(), False
+                continue
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            return response.status, response.reason, data
+
+    def close(self):
+        """Close the idle connections."""
+        while self._idle:
+            self._idle.pop().close()
+
+    def _acquire(self) -> Tuple[_UnixHTTPConnection, bool]:
+        """Return an idle connection, if there's one still open, or a new one."""
+        while self._idle:
+            connection = self._idle.pop()
+            # an idle connection has nothing to read, unless snapd closed it
+            if connection.sock and not select.select([connection.sock], [], [], 0)[0]:
+                return connection, True
+            connection.close()
+        return self._connect(), False
+
+    def _release(self, connection: _UnixHTTPConnection):
+        if len(self._idle) < self.size:
+            self._idle.append(connection)
+        else:
+            connection.close()
+
+    def _connect(self) -> _UnixHTTPConnection:
+        return _UnixHTTPConnection(self.socket_path, self.timeout)
+
+
+def _parse_time(value: str) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def remaining_time_hint(change: Dict[str, Any]) -> Optional[float]:
+    """Estimate how long, in seconds, until a change is ready, from the tasks it has completed.
+
+    snapd runs a change's tasks one after the other and records when each became ready; we assume
+    the pending tasks take as long, on average, as the completed ones.
+    """
+    spawn_time = _parse_time(change.get("spawn-time", ""))
+    tasks = change.get("tasks") or []
+    ready_times = [t for t in (_parse_time(task.get("ready-time", "")) for task in tasks) if t]
+    pending = len(tasks) - len(ready_times)
+    if not spawn_time or not ready_times or not pending:
+        return None
+    elapsed = (max(ready_times) - spawn_time).total_seconds()
+    return max(0.0, elapsed / len(ready_times) * pending)
+
+
+class SnapdClient(SnapClient):
+    """Snapd API client, extended with the snap operations the charm needs.
+
+    Each operation waits for the asynchronous snapd change it starts to complete.
+    On failure, they raise SnapAPIError if snapd rejected the request, or SnapError if the
+    change failed.
+    All requests, including the base client's queries, go out on a pool of keep-alive
+    connections.
+    """
+
+    def __init__(self, socket_path: str = "/run/snapd.socket", timeout: float = 30.0):
+        """Initialize a client talking to the snapd listening on `socket_path`."""
+        super().__init__(socket_path=socket_path, timeout=timeout)
+        self.socket_path = socket_path
+        self._base_path = urllib.parse.urlsplit(self.base_url).path
+        self._pool = _ConnectionPool(socket_path, timeout)
+
+    def close(self):
+        """Close the client's idle connections to snapd."""
+        self._pool.close()
+
+    def _request(
+        self,
+        method: str,
+        path: str,
+        query: Optional[Dict[str, str]] = None,
+        body: Optional[Dict[str, JSONAble]] = None,
+    ) -> "Optional[JSONType]":
+        """Make a JSON request to snapd and, if it starts a change, wait for it to complete."""
+        response = self._request_json(method, path, query, body)
+        if response["type"] == "async":
+            return self._wait(response["change"])
+        return response["result"]
+
+    def _request_json(
+        self,
+        method: str,
+        path: str,
+        query: Optional[Dict[str, str]] = None,
+        body: Optional[Dict[str, JSONAble]] = None,
+    ) -> Dict[str, Any]:
+        """Make a JSON request to snapd, on a pooled connection; return the decoded response.
+
+        Raises:
+            SnapAPIError: if snapd is unreachable or rejected the request, like the base client.
+        """
+        url = self._base_path + path
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        headers = {"Accept": "application/json"}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        try:
+            status, reason, payload = self._pool.request(method, url, data, headers)
+        except (OSError, http.client.HTTPException) as e:
+            raise SnapAPIError({}, 500, "Not found", str(e)) from e
+        try:
+            response = json.loads(payload.decode())
+        except ValueError as e:
+            raise SnapAPIError({}, status, reason, f"{type(e).__name__} - {e}") from e
+        if status >= 400:
+            raise SnapAPIError(response.get("result", {}), status, reason, "")
+        return response
+
+    def _wait(self, change_id: str, timeout: float = 300) -> "Optional[JSONType]":
+        """Wait for an async change to complete.
+
+        Unlike the base client, which polls every 100ms, this backs off exponentially, up to
+        POLL_MAX_INTERVAL, unless the change's completed tasks hint that it will be ready sooner.
+        """
+        with tracer.start_as_current_span("wait") as span:
+            span.set_attribute("change", change_id)
+            start = time.monotonic()
+            deadline = start + timeout
+            interval = POLL_INITIAL_INTERVAL
+            polls = 0
+            try:
+                while True:
+                    change = self._get_change(change_id)
+                    polls += 1
+                    status = change["status"]
+                    if status not in ("Do", "Doing"):
+                        break
+                    now = time.monotonic()
+                    if now > deadline:
+                        raise TimeoutError(f"timeout waiting for snap change {change_id}")
+                    delay = interval
+                    if (hint := remaining_time_hint(change)) is not None:
+                        delay = max(POLL_INITIAL_INTERVAL, min(delay, hint))
+                    time.sleep(min(delay, max(0.0, deadline - now)))
+                    interval = min(interval * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
+            finally:
+                span.set_attribute("polls", polls)
+                span.set_attribute("wait_seconds", time.monotonic() - start)
+
+            span.set_attribute("status", status)
+            if status == "Done":
+                return change.get("data")
+            if status == "Wait":
+                logger.warning("snap change %s succeeded with status 'Wait'", change_id)
+                return change.get("data")
+            raise SnapError(
+                f"snap change {change.get('kind')!r} id {change_id} failed with status {status}"
+            )
+
+    def _get_change(self, change_id: str) -> Dict[str, Any]:
+        """Fetch the state of a change."""
+        return self._request_json("GET", f"changes/{change_id}")["result"]
+
+    def install(
+        self,
+        name: str,
+        revision: Optional[str] = None,
+        channel: Optional[str] = None,
+        classic: bool = False,
+    ) -> None:
+        """Install a snap, like `snap install`."""
+        self._snap_action(name, "install", revision=revision, channel=channel, classic=classic)
+
+    def refresh(
+        self,
+        name: str,
+        revision: Optional[str] = None,
+        channel: Optional[str] = None,
+        classic: bool = False,
+    ) -> None:
+        """Refresh an installed snap, like `snap refresh`."""
+        self._snap_action(name, "refresh", revision=revision, channel=channel, classic=classic)
+
+    def hold(self, name: str) -> None:
+        """Hold the snap's refreshes indefinitely, like `snap refresh --hold <name>`."""
+        with tracer.start_as_current_span("hold") as span:
+            span.set_attribute("name", name)
+            self._request(
+                "POST",
+                f"snaps/{name}",
+                body={"action": "hold", "time": "forever", "hold-level": "general"},
+            )
+
+    def start(self, name: str, services: Optional[List[str]] = None, enable: bool = False) -> None:
+        """Start the snap's services (all of them by default), like `snap start`."""
+        names = [f"{name}.{service}" for service in services] if services else [name]
+        with tracer.start_as_current_span("start") as span:
+            span.set_attribute("name", name)
+            self._request(
+                "POST", "apps", body={"action": "start", "names": names, "enable": enable}
+            )
+
+    def set_config(self, name: str, config: Dict[str, JSONAble]) -> None:
+        """Set the snap's configuration options, like `snap set`."""
+        with tracer.start_as_current_span("set_config") as span:
+            span.set_attribute("name", name)
+            self._put_snap_conf(name, config)
+
+    def _snap_action(
+        self,
+        name: str,
+        action: str,
+        revision: Optional[str],
+        channel: Optional[str],
+        classic: bool,
+    ) -> None:
+        body: Dict[str, JSONAble] = {"action": action}
+        if revision:
+            body["revision"] = revision
+        if channel:
+            body["channel"] = channel
+        if classic:
+            body["classic"] = True
+        with tracer.start_as_current_span(action) as span:
+            span.set_attribute("name", name)
+            logger.info("%s snap %s (revision=%s, channel=%s)", action, name, revision, channel)
+            self._request("POST", f"snaps/{name}", body=body)
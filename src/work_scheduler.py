@@ -0,0 +1,74 @@
+"""Run the reconciler's steps within a per-hook time budget.
+
+Juju holds the machine's hook lock for as long as a hook runs, which blocks every other charm on
+the machine; so a hook should not keep doing heavy work once it has used up its budget.
+Steps run in the order they're added, i.e. by priority; once the budget is used up, the remaining
+steps are deferred, so that a step never runs before the steps it depends on. The first step
+always runs, so every hook makes progress.
+"""
+
+import logging
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Step(NamedTuple):
+    """A unit of reconcile work."""
+
+    name: str
+    run: Callable[[], None]
+
+
+class WorkScheduler:
+    """Run steps in priority order until the time budget is used up; defer the rest."""
+
+    def __init__(self, budget: Optional[float], clock: Callable[[], float] = time.monotonic):
+        """Initialize the scheduler.
+
+        Args:
+            budget: time, in seconds, after which no new steps are started; None means no limit.
+            clock: monotonic clock, in seconds.
+        """
+        self._budget = budget
+        self._clock = clock
+        self._steps: List[Step] = []
+        # set by `run`
+        self._start: Optional[float] = None
+
+    def add(self, name: str, run: Callable[[], None]):
+        """Schedule a step, after all the steps scheduled so far."""
+        self._steps.append(Step(name, run))
+
+    def remaining(self) -> Optional[float]:
+        """Return how much of the time budget is left, in seconds; None means no limit.
+
+        Steps that wait on something can use it to bound their wait.
+        """
+        if self._budget is None:
+            return None
+        if self._start is None:
+            return self._budget
+        return max(0.0, self._budget - (self._clock() - self._start))
+
+    def run(self) -> List[str]:
+        """Run the scheduled steps; return the names of the ones that were deferred."""
+        start = self._start = self._clock()
+        for idx, step in enumerate(self._steps):
+            elapsed = self._clock() - start
+            if idx and self._budget is not None and elapsed >= self._budget:
+                deferred = [step.name for step in self._steps[idx:]]
+                logger.warning(
+                    "hook time budget of %.1fs used up after %.1fs, deferring: %s",
+                    self._budget,
+                    elapsed,
+                    ", ".join(deferred),
+                )
+                return deferred
+            logger.debug("running reconcile step %r", step.name)
+            step.run()
+            logger.debug(
+                "reconcile step %r took %.3fs", step.name, self._clock() - start - elapsed
+            )
+        return []
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Benchmark the exporters' compression options on profile export requests.
+
+For each `exporter_compression` option whose codec is available here, this measures the bytes
+on the wire for one export request, and the CPU time it takes to compress it.
+gzip is always measured (the Python standard library has it); zstd and snappy are measured if
+the `zstandard` and `python-snappy` packages are installed.
+
+The request is read from `--payload`: the protobuf-encoded body of an OTLP
+ExportProfilesServiceRequest, e.g. as captured from a profiler on a real host. By default, one
+is synthesized: a reporter interval (5s) worth of samples of a busy 8-CPU host, protobuf-encoded
+with the layout of OTLP profiles: a dictionary of strings, functions, locations, stacks and
+attributes that the samples point into. Its ratios are indicative only; prefer a recorded one.
+
+Usage: PYTHONPATH=lib:src python tests/benchmark/bench_compression.py [--payload FILE]
+"""
+
+import argparse
+import gzip
+import random
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+# synthetic payload shape
+CPUS = 8
+SAMPLES_PER_SECOND = 19
+REPORTER_INTERVAL = 5
+PROCESSES = 40
+FUNCTIONS = 3000
+MAX_STACK_DEPTH = 48
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field(number: int, value) -> bytes:
+    """Encode a protobuf field: an int as a varint, bytes/str as length-delimited."""
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    if isinstance(value, str):
+        value = value.encode()
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _message(*fields: bytes) -> bytes:
+    return b"".join(fields)
+
+
+def synthesize_payload(seed: int = 0) -> bytes:
+    """Build an OTLP-profiles-shaped export request, deterministically."""
+    rng = random.Random(seed)
+    strings: List[str] = [""]
+    string_index: Dict[str, int] = {}
+
+    def intern(value: str) -> int:
+        if value not in string_index:
+            string_index[value] = len(strings)
+            strings.append(value)
+        return string_index[value]
+
+    modules = ["runtime", "net/http", "database/sql", "encoding/json", "syscall", "main"]
+    modules += [f"github.com/example/service{i}/pkg/handler" for i in range(20)]
+    functions = []
+    for idx in range(FUNCTIONS):
+        module = rng.choice(modules)
+        name = intern(f"{module}.(*Type{idx % 97}).Method{idx}")
+        filename = intern(f"/build/src/{module}/file{idx % 211}.go")
+        functions.append(_message(_field(1, name), _field(3, filename), _field(4, idx % 800)))
+    locations = [
+        _message(
+            _field(3, rng.randrange(0x400000, 0x7FFFFFFF)),
+            _field(4, _message(_field(1, idx), _field(2, rng.randrange(1, 2000)))),
+        )
+        for idx in range(FUNCTIONS)
+    ]
+    processes = [
+        (intern(f"service{idx}"), intern(f"/usr/bin/service{idx}"), intern(f"worker-{idx}"))
+        for idx in range(PROCESSES)
+    ]
+    attributes = []
+    for name, path, thread in processes:
+        for key, value in (
+            ("process.executable.name", name),
+            ("process.executable.path", path),
+            ("thread.name", thread),
+        ):
+            attributes.append(
+                _message(_field(1, key), _field(2, _message(_field(1, strings[value]))))
+            )
+
+    # hot paths: each process mostly hits a few stacks, sharing their common prefix
+    stacks = []
+    for _ in range(PROCESSES * 25):
+        depth = rng.randrange(8, MAX_STACK_DEPTH)
+        base = rng.randrange(0, FUNCTIONS - MAX_STACK_DEPTH)
+        stacks.append(_message(*(_field(1, base + rng.randrange(0, 6) + i) for i in range(depth))))
+
+    start_ns = 1_750_000_000_000_000_000
+    samples = []
+    for idx in range(CPUS * SAMPLES_PER_SECOND * REPORTER_INTERVAL):
+        process = rng.randrange(PROCESSES)
+        stack = process * 25 + min(int(rng.expovariate(0.5)), 24)
+        samples.append(
+            _message(
+                _field(1, stack),
+                _field(2, 1),
+                *(_field(3, process * 3 + i) for i in range(3)),
+                _field(5, start_ns + idx * 6_578_947),
+            )
+        )
+
+    dictionary = _message(
+        *(_field(2, location) for location in locations),
+        *(_field(3, function) for function in functions),
+        *(_field(5, string) for string in strings),
+        *(_field(6, attribute) for attribute in attributes),
+        *(_field(7, stack) for stack in stacks),
+    )
+    profile = _message(*(_field(3, sample) for sample in samples), _field(5, start_ns))
+    resource = _message(
+        _field(1, _message(_field(1, _message(_field(1, "host.name"), _field(2, "host"))))),
+        _field(2, _message(_field(2, profile))),
+    )
+    return _message(_field(1, resource), _field(2, dictionary))
+
+
+def _codecs() -> Dict[str, Callable[[bytes], bytes]]:
+    """The compression codecs available here, by `exporter_compression` option."""
+    # the Go gzip writer the collector uses defaults to level 6, like zlib
+    codecs: Dict[str, Callable[[bytes], bytes]] = {
+        "none": lambda data: data,
+        "gzip": lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+    }
+    try:
+        import zstandard
+
+        # the collector's default zstd level
+        codecs["zstd"] = zstandard.ZstdCompressor(level=3).compress
+    except ImportError:
+        pass
+    try:
+        import snappy
+
+        codecs["snappy"] = snappy.compress
+    except ImportError:
+        pass
+    return codecs
+
+
+def _cpu_ms(fn: Callable[[], object], iterations: int) -> float:
+    """Return the mean CPU time of `fn`, in milliseconds."""
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time() - start) / iterations * 1000
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--payload", type=Path, help="recorded export request body (protobuf)")
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    payload = args.payload.read_bytes() if args.payload else synthesize_payload()
+    source = str(args.payload) if args.payload else "synthesized"
+    print(f"export request: {len(payload) / 1024:.1f} KiB ({source})")
+    print(f"  {'compression':<12} {'bytes on the wire':>18} {'ratio':>7} {'CPU ms':>8}")
+    for name, compress in _codecs().items():
+        size = len(compress(payload))
+        cpu = _cpu_ms(lambda: compress(payload), args.iterations)
+        print(f"  {name:<12} {size:>18} {len(payload) / size:>6.1f}x {cpu:>8.2f}")
+    missing = {"zstd", "snappy"} - set(_codecs())
+    if missing:
+        print(f"  (not measured, codec not installed: {', '.join(sorted(missing))})")
+
+
+if __name__ == "__main__":
+    main()
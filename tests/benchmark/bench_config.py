@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Benchmark rendering and hashing the collector config, as every reconciling hook does.
+
+The config is that of a unit with topology labels and 3 profiling backends. "Before" renders
+it the way older charm revisions did: with the pure-python YAML dumper, then hashing a second
+YAML serialization of the rendered config. "After" is the current `ConfigManager.build`, which
+serializes once, with the libyaml-backed dumper if PyYAML was built with it.
+
+Usage: PYTHONPATH=lib:src python tests/benchmark/bench_config.py [--iterations N]
+"""
+
+import argparse
+import platform
+import time
+from unittest.mock import patch
+
+import yaml
+from charms.pyroscope_coordinator_k8s.v0.profiling import Endpoint
+
+import config_builder
+from config_builder import ConfigBuilder, sha256
+from config_manager import ConfigManager
+
+TOPOLOGY = {
+    "model": "profiling",
+    "model_uuid": "00000000-0000-4000-8000-000000000000",
+    "application": "otel-ebpf-profiler",
+    "unit": "otel-ebpf-profiler/0",
+    "charm_name": "otel-ebpf-profiler",
+}
+ENDPOINTS = [Endpoint(f"backend{i}:4317", insecure=True) for i in range(3)]
+
+
+def _build():
+    manager = ConfigManager()
+    manager.add_topology_labels(TOPOLOGY)
+    manager.add_profile_forwarding(ENDPOINTS)
+    return manager.build()
+
+
+def _timeit(iterations: int) -> float:
+    """Return the mean duration of a build, in microseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _build()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    with (
+        patch.object(config_builder, "SafeDumper", yaml.SafeDumper),
+        patch.object(ConfigBuilder, "hash", staticmethod(lambda cfg: sha256(yaml.safe_dump(cfg)))),
+    ):
+        before = _timeit(args.iterations)
+    after = _timeit(args.iterations)
+
+    libyaml = "with" if config_builder.SafeDumper is not yaml.SafeDumper else "without"
+    print(f"config build + hash, python {platform.python_version()} {libyaml} libyaml:")
+    print(f"  before: {before:8.0f} us/hook")
+    print(f"  after:  {after:8.0f} us/hook ({before / after:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
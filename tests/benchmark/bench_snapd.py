@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Benchmark installing, configuring, holding and starting a snap through the snapd API.
+
+The snapd API is served by the fake snapd of the unit tests, which completes changes right away,
+so this measures the client-side cost of each path. The `snap` CLI sends the very same requests to
+snapd, after the charm forked it and it started up: its cost is modelled as the API calls plus
+one process spawn per operation. The spawn is timed on the `snap` binary if it's installed (`snap
+--version`), or on `true` otherwise, which underestimates it.
+
+It then measures the throughput, in requests per second, of a snapd query (`GET /v2/snaps`) with
+the library's client, which connects anew for each request, and with our client, which reuses a
+keep-alive connection.
+
+Usage: PYTHONPATH=lib:src python tests/benchmark/bench_snapd.py [--iterations N]
+"""
+
+import argparse
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "unit"))
+
+from fake_snapd import FakeSnapd  # noqa: E402
+from charms.operator_libs_linux.v2.snap import SnapClient  # noqa: E402
+from snapd_client import SnapdClient  # noqa: E402
+
+# install, set, refresh --hold, start
+OPERATIONS_PER_SETUP = 4
+
+
+def _timeit(fn: Callable[[], None], iterations: int) -> float:
+    """Return the mean duration of `fn`, in milliseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def _requests_per_second(client: SnapClient, requests: int) -> float:
+    """Return how many snapd queries per second `client` makes."""
+    return 1000 / _timeit(client.get_installed_snaps, requests)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    if snap := shutil.which("snap"):
+        spawn_cmd = [snap, "--version"]
+    else:
+        spawn_cmd = [shutil.which("true") or "/bin/true"]
+
+    def spawn():
+        subprocess.run(spawn_cmd, check=True, stdout=subprocess.DEVNULL)
+
+    with tempfile.TemporaryDirectory(prefix="snapd") as tmp:
+        with FakeSnapd(str(Path(tmp) / "snapd.socket")) as snapd:
+            client = SnapdClient(socket_path=snapd.socket_path)
+
+            def rest_setup():
+                client.install("foo", revision="6", classic=True)
+                client.set_config("foo", {"bar": "baz"})
+                client.hold("foo")
+                client.start("foo", enable=True)
+
+            rest = _timeit(rest_setup, args.iterations)
+            per_connection = _requests_per_second(
+                SnapClient(socket_path=snapd.socket_path), args.requests
+            )
+            pooled = _requests_per_second(client, args.requests)
+            client.close()
+    spawns = _timeit(spawn, args.iterations) * OPERATIONS_PER_SETUP
+    cli = rest + spawns
+
+    print(f"{OPERATIONS_PER_SETUP} operations, with `{' '.join(spawn_cmd)}` as the process spawn:")
+    print(f"  snapd API:           {rest:8.2f} ms")
+    print(f"  snap CLI (modelled): {cli:8.2f} ms")
+    print(f"  saving:              {spawns:8.2f} ms per install ({cli / rest:.1f}x)")
+    print(f"{args.requests} snapd queries:")
+    print(f"  connection per request: {per_connection:8.0f} req/s")
+    print(f"  keep-alive connection:  {pooled:8.0f} req/s ({pooled / per_connection:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
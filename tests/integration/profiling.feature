@@ -4,4 +4,8 @@ Feature: profiling
     Given an ebpf profiler charm is deployed on a juju virtual machine
     * an otel collector charm is deployed on the same machine
     When the profiler is integrated with the collector over profiling
-    Then system-wide profiles are successfully pushed to the collector
\ No newline at end of file
+    Then the profiler runs the rendered config, with its memory limiter, batching and forwarding
+    * system-wide profiles are successfully pushed to the collector
+    * the profiler reports the profiles going through its memory limiter
+    When the profiler is configured to drop the profiles of kernel workers
+    Then the profiler runs the rendered config, with its profile filter
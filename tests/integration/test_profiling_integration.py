@@ -1,5 +1,6 @@
 import pytest
 import jubilant
+import yaml
 from jubilant import Juju, all_blocked
 from tenacity import retry, stop_after_attempt, wait_fixed
 
@@ -17,6 +18,21 @@ from pytest_bdd import given, when, then
 pytestmark = pytest.mark.usefixtures("patch_update_status_interval")
 
 
+def _running_config(juju: Juju) -> dict:
+    """Return the config the charm rendered, asserting the profiler is running it."""
+    unit_name = list(juju.status().apps[APP_NAME].units.keys())[0]
+    config = yaml.safe_load(juju.ssh(unit_name, "sudo cat /etc/otel-ebpf-profiler/config.yaml"))
+    # the profiler tags its own telemetry with the config's generation, which it only does
+    # once the config has loaded
+    generation = config["service"]["telemetry"]["resource"]["charm.config.generation"]
+    metrics = juju.ssh(unit_name, "curl -s http://localhost:9999/metrics")
+    assert any(
+        line.startswith("target_info") and f'charm_config_generation="{generation}"' in line
+        for line in metrics.splitlines()
+    ), f"the profiler isn't running config generation {generation}"
+    return config
+
+
 @pytest.mark.setup
 @given("an ebpf profiler charm is deployed on a juju virtual machine")
 def test_deploy(juju: Juju, charm):
@@ -74,6 +90,21 @@ def test_integrate_profiling(juju: Juju):
     patch_otel_collector_log_level(juju)
 
 
+@retry(stop=stop_after_attempt(10), wait=wait_fixed(10))
+@then("the profiler runs the rendered config, with its memory limiter, batching and forwarding")
+def test_rendered_config_loaded(juju: Juju):
+    config = _running_config(juju)
+    # the stages the charm renders by default are all there
+    pipelines = config["service"]["pipelines"]
+    assert pipelines["profiles"]["processors"][0] == "memory_limiter/profiling"
+    assert pipelines["profiles"]["exporters"] == ["forward/profiling"]
+    assert pipelines["profiles/0"] == {
+        "receivers": ["forward/profiling"],
+        "processors": ["batch/profiling"],
+        "exporters": ["otlp/profiling/0"],
+    }
+
+
 @retry(stop=stop_after_attempt(10), wait=wait_fixed(10))
 @then("system-wide profiles are successfully pushed to the collector")
 def test_profiles_are_pushed(juju: Juju):
@@ -84,3 +115,40 @@ def test_profiles_are_pushed(juju: Juju):
         '"sample records"',
     ]
     assert_pattern_in_snap_logs(juju, grep_filters)
+
+
+@retry(stop=stop_after_attempt(10), wait=wait_fixed(10))
+@then("the profiler reports the profiles going through its memory limiter")
+def test_memory_limiter_metrics(juju: Juju):
+    # the charm's status and the memory limiter alert rely on these series
+    unit_name = list(juju.status().apps[APP_NAME].units.keys())[0]
+    metrics = juju.ssh(unit_name, "curl -s http://localhost:9999/metrics")
+    for series in ("otelcol_processor_incoming_items", "otelcol_processor_outgoing_items"):
+        assert any(
+            line.startswith(series)
+            and 'processor="memory_limiter/profiling"' in line
+            and 'otel_signal="profiles"' in line
+            for line in metrics.splitlines()
+        ), f"{series} not reported for the memory limiter's profiles"
+
+
+@when("the profiler is configured to drop the profiles of kernel workers")
+def test_configure_profile_filter(juju: Juju):
+    juju.config(APP_NAME, {"filter_exclude": 'process_name: ["^kworker/.*"]'})
+    juju.wait(
+        lambda status: jubilant.all_active(status, APP_NAME),
+        timeout=10 * 60,
+        error=lambda status: jubilant.any_error(status, APP_NAME),
+        delay=10,
+        successes=3,
+    )
+
+
+@retry(stop=stop_after_attempt(10), wait=wait_fixed(10))
+@then("the profiler runs the rendered config, with its profile filter")
+def test_profile_filter_loaded(juju: Juju):
+    config = _running_config(juju)
+    # the filter's conditions are evaluated on each sample
+    assert config["processors"]["filter/profiling"]["profiles"] == {
+        "sample": ['IsMatch(attributes["process.executable.name"], "^kworker/.*")']
+    }
@@ -34,6 +34,24 @@ def snap_mocks():
         yield SnapMocks(charm_snap=snapmock, snap_mgmt=snapmgmmock)
 
 
+@pytest.fixture(autouse=True)
+def mock_profiler_metrics():
+    with patch("profiler_metrics.scrape", return_value=None) as scrape:
+        yield scrape
+
+
+@pytest.fixture(autouse=True)
+def mock_reload_ack():
+    with patch("profiler_metrics.wait_for_config_generation", return_value=0.5) as wait:
+        yield wait
+
+
+@pytest.fixture(autouse=True)
+def mock_host_memory():
+    with patch("host_capabilities.total_memory_mib", return_value=4096) as mem:
+        yield mem
+
+
 @pytest.fixture
 def ctx():
     return Context(OtelEbpfProfilerCharm)
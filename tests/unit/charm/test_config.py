@@ -3,10 +3,20 @@
 # See LICENSE file for licensing details.
 
 import json
+import re
+import ops
 import yaml
 from ops.testing import Relation, State, CharmEvents
 import pytest
-from config_builder import TOPOLOGY_INJECTOR_PROCESSOR_NAME
+from config_manager import FORWARD_CONNECTOR_NAME
+from config_builder import (
+    BATCH_PROCESSOR_NAME,
+    FILE_STORAGE_EXTENSION_NAME,
+    FILTER_PROCESSOR_NAME,
+    MEMORY_LIMITER_PROCESSOR_NAME,
+    TOPOLOGY_INJECTOR_PROCESSOR_NAME,
+    sha256,
+)
 
 
 def get_updated_config(snap_mocks):
@@ -15,6 +25,19 @@ def get_updated_config(snap_mocks):
     return yaml.safe_load(call_args[0][0])
 
 
+def _profiling_relations(n):
+    return {
+        Relation(
+            endpoint="profiling",
+            remote_app_data={
+                "otlp_grpc_endpoint_url": json.dumps(f"backend{i}:4317"),
+                "insecure": json.dumps(True),
+            },
+        )
+        for i in range(n)
+    }
+
+
 @pytest.mark.parametrize("event", (CharmEvents.update_status(), CharmEvents.config_changed()))
 def test_config_topology_labels_processor(ctx, event, snap_mocks):
     # GIVEN the unit is leader
@@ -74,9 +97,356 @@ def test_profiling_exporter_config(ctx, snap_mocks, remote_tls, ca, mock_ca_cert
     assert "otlp/profiling/0" in exporters
     assert exporters["otlp/profiling/0"] == {
         "endpoint": "grpc.server:1234",
+        "compression": "gzip",
+        "sending_queue": {
+            "enabled": True,
+            "queue_size": 1000,
+            "num_consumers": 2,
+        },
+        "retry_on_failure": {
+            "enabled": True,
+            "initial_interval": "5s",
+            "max_interval": "30s",
+            "max_elapsed_time": "5m",
+        },
+        "timeout": "10s",
         "tls": {
             "insecure": not remote_tls,
             "insecure_skip_verify": False,
             **({"ca_file": str(mock_ca_cert)} if ca else {}),
         },
     }
+
+
+def test_config_hash_matches_rendered_config(ctx, snap_mocks):
+    # WHEN we receive any event
+    ctx.run(ctx.on.update_status(), State())
+    # THEN the hash we pass along is the hash of the exact config we'd write to disk
+    config, config_hash, _ = snap_mocks.snap_mgmt.update_config.call_args[0]
+    assert config_hash == sha256(config)
+
+
+def test_profiling_receiver_default_config(ctx, snap_mocks):
+    # WHEN we receive any event with the default charm config
+    ctx.run(ctx.on.update_status(), State())
+    # THEN the profiling receiver is rendered with the default tuning
+    config = get_updated_config(snap_mocks)
+    assert config["receivers"]["profiling"] == {
+        "SamplesPerSecond": 19,
+        "ReporterInterval": "5s",
+        "ProbabilisticThreshold": 100,
+        "ProbabilisticInterval": "1m",
+        "Tracers": "all",
+    }
+
+
+def test_profiling_receiver_tuning(ctx, snap_mocks):
+    # GIVEN the user tunes the profiling receiver
+    charm_config = {
+        "sampling_frequency": 99,
+        "reporter_interval": "10s",
+        "probabilistic_threshold": 50,
+        "probabilistic_interval": "2m30s",
+        "tracers": "native, python,go",
+        "off_cpu_threshold": 0.01,
+    }
+    # WHEN the config changes
+    ctx.run(ctx.on.config_changed(), State(config=charm_config))
+    # THEN the profiling receiver is rendered accordingly
+    config = get_updated_config(snap_mocks)
+    assert config["receivers"]["profiling"] == {
+        "SamplesPerSecond": 99,
+        "ReporterInterval": "10s",
+        "ProbabilisticThreshold": 50,
+        "ProbabilisticInterval": "2m30s",
+        "Tracers": "native,python,go",
+        "OffCPUThreshold": 0.01,
+    }
+    # AND the profiler gets hot-reloaded
+    assert snap_mocks.snap_mgmt.reload.called
+
+
+@pytest.mark.parametrize(
+    "charm_config",
+    (
+        # profiling receiver
+        {"sampling_frequency": 0},
+        {"sampling_frequency": 100000},
+        {"reporter_interval": "5 seconds"},
+        {"reporter_interval": "0s"},
+        {"probabilistic_threshold": 101},
+        {"probabilistic_interval": ""},
+        {"tracers": "python,cobol"},
+        {"tracers": ","},
+        {"off_cpu_threshold": -0.1},
+        {"off_cpu_threshold": 0.5},
+        # batching
+        {"batch_send_size": 0},
+        {"batch_send_size": 100, "batch_max_size": 10},
+        {"batch_timeout": "0s"},
+        {"batch_timeout": "soon"},
+        # memory limiter
+        {"memory_limit_mib": -1},
+        {"memory_limit_mib": 300, "memory_spike_limit_mib": 300},
+        {"memory_spike_limit_mib": -5},
+        # profile filters
+        {"filter_include": "process_name: postgres"},
+        {"filter_include": "- postgres"},
+        {"filter_include": "process_name: [postgres"},
+        {"filter_exclude": 'pid: ["1"]'},
+        {"filter_exclude": 'process_name: ["(unbalanced"]'},
+        # valid in Python, but not in the RE2 syntax of the collector's IsMatch
+        {"filter_exclude": 'process_name: ["postgres(?!ql)"]'},
+        {"filter_exclude": 'executable_path: ["(?<=/usr)/bin"]'},
+        {"filter_include": "process_name: ['(a)\\1']"},
+        {"filter_include": 'process_name: ["a++"]'},
+        {"filter_include": 'container_id: ["^4f3a\\\\Z"]'},
+        # exporters
+        {"exporter_compression": "lz4"},
+        {"sending_queue_size": 0},
+        {"sending_queue_consumers": 0},
+        {"sending_queue_storage_directory": "relative/path"},
+        {"retry_initial_interval": "0s"},
+        {"retry_initial_interval": "1m", "retry_max_interval": "30s"},
+        {"retry_max_interval": "1m", "retry_max_elapsed_time": "30s"},
+        {"retry_max_elapsed_time": "forever"},
+        {"exporter_timeout": "0s"},
+        {"exporter_timeout": "1h"},
+        {"export_mode": "round-robin"},
+    ),
+)
+def test_invalid_config(ctx, snap_mocks, charm_config):
+    # WHEN the user sets an invalid config
+    state_out = ctx.run(ctx.on.config_changed(), State(config=charm_config))
+    # THEN the unit is blocked
+    assert isinstance(state_out.unit_status, ops.BlockedStatus)
+    assert state_out.unit_status.message.startswith("Invalid config: ")
+    # AND the config on disk is left untouched
+    assert not snap_mocks.snap_mgmt.update_config.called
+
+    # AND WHEN another hook fires
+    state_out = ctx.run(ctx.on.update_status(), state_out)
+    # THEN the unit is still blocked
+    assert isinstance(state_out.unit_status, ops.BlockedStatus)
+
+
+def test_batch_processor(ctx, snap_mocks):
+    # GIVEN the user tunes the batching
+    charm_config = {"batch_send_size": 100, "batch_max_size": 0, "batch_timeout": "1s"}
+    # WHEN we receive any event
+    ctx.run(ctx.on.config_changed(), State(config=charm_config))
+    # THEN the batch processor is the last stage of the profiles pipeline
+    config = get_updated_config(snap_mocks)
+    assert config["processors"][BATCH_PROCESSOR_NAME] == {
+        "send_batch_size": 100,
+        "send_batch_max_size": 0,
+        "timeout": "1s",
+    }
+    assert config["service"]["pipelines"]["profiles"]["processors"][-1] == BATCH_PROCESSOR_NAME
+
+
+@pytest.mark.parametrize(
+    "host_memory, limit, spike",
+    (
+        (4096, 409, 81),
+        # the derived limit is capped on both ends
+        (1024, 256, 51),
+        (512 * 1024, 2048, 409),
+    ),
+)
+def test_memory_limiter_derived_from_host_memory(
+    ctx, snap_mocks, mock_host_memory, host_memory, limit, spike
+):
+    # GIVEN a host with some memory
+    mock_host_memory.return_value = host_memory
+    # WHEN we receive any event with the default charm config
+    ctx.run(ctx.on.update_status(), State())
+    # THEN the memory limiter is the first stage of the profiles pipeline
+    config = get_updated_config(snap_mocks)
+    assert config["service"]["pipelines"]["profiles"]["processors"][0] == (
+        MEMORY_LIMITER_PROCESSOR_NAME
+    )
+    # AND its limits are derived from the host memory
+    assert config["processors"][MEMORY_LIMITER_PROCESSOR_NAME] == {
+        "check_interval": "1s",
+        "limit_mib": limit,
+        "spike_limit_mib": spike,
+    }
+
+
+def test_memory_limiter_override(ctx, snap_mocks):
+    # GIVEN the user sets the memory limits
+    charm_config = {"memory_limit_mib": 300, "memory_spike_limit_mib": 100}
+    # WHEN we receive any event
+    ctx.run(ctx.on.config_changed(), State(config=charm_config))
+    # THEN the memory limiter uses them
+    config = get_updated_config(snap_mocks)
+    limiter = config["processors"][MEMORY_LIMITER_PROCESSOR_NAME]
+    assert (limiter["limit_mib"], limiter["spike_limit_mib"]) == (300, 100)
+
+
+def test_profile_filter_disabled_by_default(ctx, snap_mocks):
+    # WHEN we receive any event with the default charm config
+    ctx.run(ctx.on.update_status(), State())
+    # THEN no profiles are filtered
+    config = get_updated_config(snap_mocks)
+    assert FILTER_PROCESSOR_NAME not in config["processors"]
+
+
+# where the eBPF profiler sets the attributes profiles can be filtered by
+EBPF_PROFILER_ATTRIBUTES = {
+    # on each sample
+    "attributes": {"process.executable.name", "process.executable.path"},
+    # on the resource of the profiles of each container
+    "resource.attributes": {"container.id"},
+}
+
+
+def test_profile_filter(ctx, snap_mocks):
+    # GIVEN the user sets both an include and an exclude filter, on all the filter keys
+    charm_config = {
+        "filter_include": 'process_name: ["postgres"]\ncontainer_id: ["^4f3a"]',
+        "filter_exclude": 'executable_path: ["/usr/lib/\\"tmp\\"/.*"]',
+    }
+    # WHEN we receive any event
+    ctx.run(ctx.on.config_changed(), State(config=charm_config))
+    # THEN the filter processor evaluates its conditions on each profile sample
+    config = get_updated_config(snap_mocks)
+    processor = config["processors"][FILTER_PROCESSOR_NAME]
+    assert processor["error_mode"] == "ignore"
+    include, exclude = processor["profiles"]["sample"]
+    # AND it drops whatever isn't included, then whatever is excluded
+    assert include.startswith("not (") and " or " in include
+    assert exclude.startswith("IsMatch(")
+    # AND each key is matched where the profiler sets it: on the sample, or its resource
+    paths = re.findall(r'IsMatch\(((?:resource\.)?attributes)\["([^"]+)"\], "', include + exclude)
+    assert sorted(paths) == sorted(
+        (level, key) for level, keys in EBPF_PROFILER_ATTRIBUTES.items() for key in keys
+    )
+    assert '"/usr/lib/\\"tmp\\"/.*"' in exclude
+    # AND profiles are filtered right after the memory limiter, before any other processing
+    assert config["service"]["pipelines"]["profiles"]["processors"][:2] == [
+        MEMORY_LIMITER_PROCESSOR_NAME,
+        FILTER_PROCESSOR_NAME,
+    ]
+
+
+@pytest.mark.parametrize("compression", ("gzip", "zstd", "snappy", "none"))
+def test_exporter_compression(ctx, snap_mocks, compression):
+    # GIVEN a profiling integration
+    # WHEN the user sets the exporter compression
+    ctx.run(
+        ctx.on.config_changed(),
+        State(relations=_profiling_relations(1), config={"exporter_compression": compression}),
+    )
+    # THEN the profiling exporter uses it
+    config = get_updated_config(snap_mocks)
+    assert config["exporters"]["otlp/profiling/0"]["compression"] == compression
+
+
+def test_exporter_compression_not_on_debug_exporter(ctx, snap_mocks):
+    # GIVEN no profiling integration
+    # WHEN we receive any event
+    ctx.run(ctx.on.update_status(), State())
+    # THEN the debug exporter gets no compression setting
+    config = get_updated_config(snap_mocks)
+    assert "compression" not in config["exporters"]["debug"]
+
+
+@pytest.mark.parametrize("storage_directory", ("/var/lib/queue", ""))
+def test_sending_queue(ctx, snap_mocks, storage_directory):
+    # GIVEN a profiling integration
+    charm_config = {
+        "sending_queue_size": 50,
+        "sending_queue_consumers": 3,
+        "sending_queue_storage_directory": storage_directory,
+    }
+    # WHEN the user configures the sending queue
+    ctx.run(ctx.on.config_changed(), State(relations=_profiling_relations(1), config=charm_config))
+    # THEN the profiling exporter uses it
+    config = get_updated_config(snap_mocks)
+    sending_queue = config["exporters"]["otlp/profiling/0"]["sending_queue"]
+    assert sending_queue["queue_size"] == 50
+    assert sending_queue["num_consumers"] == 3
+    # AND the queue is persisted only if a storage directory is set
+    if storage_directory:
+        assert sending_queue["storage"] == FILE_STORAGE_EXTENSION_NAME
+        assert config["extensions"][FILE_STORAGE_EXTENSION_NAME]["directory"] == storage_directory
+        assert config["service"]["extensions"] == [FILE_STORAGE_EXTENSION_NAME]
+    else:
+        assert "storage" not in sending_queue
+        assert not config["extensions"]
+
+
+def test_exporter_retry(ctx, snap_mocks):
+    # GIVEN a profiling integration
+    charm_config = {
+        "retry_initial_interval": "1s",
+        "retry_max_interval": "10s",
+        "retry_max_elapsed_time": "0s",
+        "exporter_timeout": "30s",
+    }
+    # WHEN the user configures the retry policy
+    ctx.run(ctx.on.config_changed(), State(relations=_profiling_relations(1), config=charm_config))
+    # THEN the profiling exporter uses it
+    config = get_updated_config(snap_mocks)
+    exporter = config["exporters"]["otlp/profiling/0"]
+    assert exporter["retry_on_failure"] == {
+        "enabled": True,
+        "initial_interval": "1s",
+        "max_interval": "10s",
+        "max_elapsed_time": "0s",
+    }
+    assert exporter["timeout"] == "30s"
+
+
+def test_export_mode_broadcast(ctx, snap_mocks):
+    # GIVEN three profiling backends
+    # WHEN we receive any event in broadcast mode
+    ctx.run(ctx.on.update_status(), State(relations=_profiling_relations(3)))
+    # THEN we export to all of them
+    config = get_updated_config(snap_mocks)
+    endpoints = {exporter["endpoint"] for exporter in config["exporters"].values()}
+    assert endpoints == {"backend0:4317", "backend1:4317", "backend2:4317"}
+    # AND each exporter gets settings of its own, rather than YAML aliases of shared ones
+    assert "&id" not in snap_mocks.snap_mgmt.update_config.call_args[0][0]
+
+
+def test_export_mode_load_balance(ctx, snap_mocks):
+    # GIVEN three profiling backends
+    # WHEN we receive any event in load-balance mode
+    ctx.run(
+        ctx.on.config_changed(),
+        State(relations=_profiling_relations(3), config={"export_mode": "load-balance"}),
+    )
+    # THEN we export to a single one of them
+    config = get_updated_config(snap_mocks)
+    assert list(config["exporters"]) == ["otlp/profiling/0"]
+    assert config["exporters"]["otlp/profiling/0"]["endpoint"] in {
+        "backend0:4317",
+        "backend1:4317",
+        "backend2:4317",
+    }
+
+
+def test_per_exporter_pipeline_isolation(ctx, snap_mocks):
+    # GIVEN two profiling backends
+    # WHEN we receive any event in broadcast mode
+    ctx.run(ctx.on.update_status(), State(relations=_profiling_relations(2)))
+    # THEN the profiles pipeline fans out through a forward connector
+    config = get_updated_config(snap_mocks)
+    pipelines = config["service"]["pipelines"]
+    assert FORWARD_CONNECTOR_NAME in config["connectors"]
+    assert pipelines["profiles"]["exporters"] == [FORWARD_CONNECTOR_NAME]
+    assert BATCH_PROCESSOR_NAME not in pipelines["profiles"]["processors"]
+    # AND each exporter gets its own branch, with its own batching
+    assert pipelines["profiles/0"] == {
+        "receivers": [FORWARD_CONNECTOR_NAME],
+        "processors": [BATCH_PROCESSOR_NAME],
+        "exporters": ["otlp/profiling/0"],
+    }
+    assert pipelines["profiles/1"] == {
+        "receivers": [FORWARD_CONNECTOR_NAME],
+        "processors": [BATCH_PROCESSOR_NAME],
+        "exporters": ["otlp/profiling/1"],
+    }
@@ -1,11 +1,17 @@
+import dataclasses
 import json
+from unittest.mock import patch
 
 import ops
+import yaml
 from ops.testing import State, CharmEvents, Relation
 import pytest
 
+import profiler_metrics
+import snap_management
 from charm import OtelEbpfProfilerCharm
 from charms.operator_libs_linux.v2 import snap
+from work_scheduler import WorkScheduler
 
 
 @pytest.mark.parametrize(
@@ -88,7 +94,9 @@ def test_install_snap(ctx, event, snap_mocks):
         "profiling machine <testing>, no profiling ingester/backend connected"
     )
     assert snap_mocks.snap_mgmt.install_snap.called
-    assert snap_mocks.charm_snap.return_value.start.called
+    snap_mocks.snap_mgmt.start_snap.assert_called_once_with(
+        OtelEbpfProfilerCharm._snap_name, enable=True
+    )
 
 
 @pytest.mark.parametrize("event", (CharmEvents.upgrade_charm(), CharmEvents.install()))
@@ -150,3 +158,309 @@ def test_config_reload(ctx, event, snap_mocks, changes):
     assert state_out.unit_status == ops.ActiveStatus(
         "profiling machine <testing>, no profiling ingester/backend connected"
     )
+
+
+def _running_generation(generation):
+    """Return a scrape of a profiler reporting it's running the config `generation`."""
+    return profiler_metrics.parse(f'target_info{{charm_config_generation="{generation}"}} 1\n')
+
+
+def test_config_reload_verified(ctx, snap_mocks, mock_profiler_metrics, mock_reload_ack):
+    snap_mocks.snap_mgmt.update_config.return_value = True
+    # GIVEN the profiler reports the config it's running
+    mock_profiler_metrics.return_value = _running_generation("old")
+    # WHEN the config changes
+    ctx.run(ctx.on.update_status(), State(leader=True))
+    # THEN we wait for the profiler to report running the config we've just written
+    generation = yaml.safe_load(snap_mocks.snap_mgmt.update_config.call_args[0][0])["service"][
+        "telemetry"
+    ]["resource"]["charm.config.generation"]
+    assert mock_reload_ack.call_args[0][0] == generation
+    # AND no longer than the hook's time budget allows
+    assert mock_reload_ack.call_args.kwargs["timeout"] <= 5
+    # AND since it does, it's not restarted
+    assert not snap_mocks.charm_snap.return_value.restart.called
+
+
+def test_config_reload_falls_back_to_restart(
+    ctx, snap_mocks, mock_profiler_metrics, mock_reload_ack
+):
+    snap_mocks.snap_mgmt.update_config.return_value = True
+    snap_mocks.snap_mgmt.service_state.return_value.active_state = "active"
+    # GIVEN the profiler doesn't pick up the new config after a SIGHUP
+    mock_profiler_metrics.return_value = _running_generation("old")
+    mock_reload_ack.return_value = None
+    # WHEN the config changes, in a hook with time to spare
+    ctx.run(ctx.on.update_status(), State(leader=True, config={"reconcile_time_budget": "0s"}))
+    # THEN the profiler gets restarted
+    assert snap_mocks.snap_mgmt.reload.called
+    assert snap_mocks.charm_snap.return_value.restart.called
+
+
+def test_config_reload_unverified_without_metrics(ctx, snap_mocks, mock_reload_ack):
+    snap_mocks.snap_mgmt.update_config.return_value = True
+    # GIVEN the profiler's metrics can't be scraped
+    # WHEN the config changes
+    ctx.run(ctx.on.update_status(), State(leader=True))
+    # THEN the profiler is reloaded
+    assert snap_mocks.snap_mgmt.reload.called
+    # AND not restarted for failing to report the new config, which it never reported
+    assert not mock_reload_ack.called
+    assert not snap_mocks.charm_snap.return_value.restart.called
+
+
+def test_config_reload_restart_deferred_over_budget(
+    ctx, snap_mocks, mock_profiler_metrics, mock_reload_ack
+):
+    snap_mocks.snap_mgmt.update_config.return_value = True
+    snap_mocks.snap_mgmt.service_state.return_value.active_state = "active"
+    # GIVEN the profiler doesn't pick up the new config within the hook's time budget
+    mock_profiler_metrics.return_value = _running_generation("old")
+    mock_reload_ack.return_value = None
+    # WHEN the config changes
+    with patch("charm.shutil.which", return_value=None):
+        state_out = ctx.run(ctx.on.update_status(), State(leader=True))
+    # THEN the profiler is reloaded, but not restarted within this hook
+    assert snap_mocks.snap_mgmt.reload.call_count == 1
+    assert not snap_mocks.charm_snap.return_value.restart.called
+    assert state_out.unit_status == ops.ActiveStatus(
+        "profiling machine <testing>, no profiling ingester/backend connected, deferred: reload"
+    )
+
+    # AND WHEN the next hook fires and the profiler still runs the old config
+    ctx.run(ctx.on.update_status(), state_out)
+    # THEN it's restarted right away, without reloading it again
+    assert snap_mocks.snap_mgmt.reload.call_count == 1
+    assert mock_reload_ack.call_count == 1
+    assert snap_mocks.charm_snap.return_value.restart.called
+
+
+def test_config_reload_coalesced(ctx, snap_mocks, mock_reload_ack):
+    snap_mocks.snap_mgmt.update_config.return_value = True
+    # GIVEN reloads are coalesced
+    state = State(leader=True, config={"reload_coalesce_window": "30s"})
+    # WHEN the config changes
+    ctx.run(ctx.on.config_changed(), state)
+    # THEN the config is written right away
+    assert snap_mocks.snap_mgmt.update_config.called
+    # AND a reload is scheduled at the end of the window, instead of happening now
+    snap_mocks.snap_mgmt.schedule_reload.assert_called_once_with(
+        OtelEbpfProfilerCharm._snap_name, OtelEbpfProfilerCharm._service_name, 30
+    )
+    assert not snap_mocks.snap_mgmt.reload.called
+
+
+def test_reconcile_fast_path_skips_unchanged_inputs(ctx, snap_mocks):
+    # GIVEN a first hook went through a full reconcile
+    state_out = ctx.run(ctx.on.update_status(), State(leader=True))
+    assert snap_mocks.snap_mgmt.update_config.call_count == 1
+
+    # WHEN another hook fires and none of the inputs have changed
+    ctx.run(ctx.on.update_status(), state_out)
+
+    # THEN the config reconcile is skipped
+    assert snap_mocks.snap_mgmt.update_config.call_count == 1
+
+
+def test_reconcile_fast_path_runs_on_changed_inputs(ctx, snap_mocks):
+    # GIVEN a first hook went through a full reconcile
+    state_out = ctx.run(ctx.on.update_status(), State(leader=True))
+
+    # WHEN a profiling backend gets related
+    profiling = Relation(
+        "profiling",
+        remote_app_data={
+            "otlp_grpc_endpoint_url": json.dumps("foo.com"),
+            "insecure": json.dumps(True),
+        },
+    )
+    ctx.run(
+        ctx.on.relation_changed(profiling),
+        dataclasses.replace(state_out, relations={profiling}),
+    )
+
+    # THEN the config gets reconciled again
+    assert snap_mocks.snap_mgmt.update_config.call_count == 2
+
+
+def test_reconcile_fast_path_reset_on_setup(ctx, snap_mocks):
+    # GIVEN a first hook went through a full reconcile
+    state_out = ctx.run(ctx.on.update_status(), State(leader=True))
+
+    # WHEN the charm gets upgraded
+    state_out = ctx.run(ctx.on.upgrade_charm(), state_out)
+    # AND another hook fires with unchanged inputs
+    ctx.run(ctx.on.update_status(), state_out)
+
+    # THEN the config gets reconciled again, as the new charm code may render it differently
+    assert snap_mocks.snap_mgmt.update_config.call_count == 2
+
+
+def test_memory_limiter_refusing_status(ctx, snap_mocks, mock_profiler_metrics):
+    # GIVEN the memory limiter has refused some profiles
+    mock_profiler_metrics.return_value = profiler_metrics.parse(
+        'otelcol_processor_incoming_items_total{otel_signal="profiles",'
+        'processor="memory_limiter/profiling"} 50\n'
+        'otelcol_processor_outgoing_items_total{otel_signal="profiles",'
+        'processor="memory_limiter/profiling"} 8\n'
+    )
+    # WHEN we receive any event
+    state_out = ctx.run(ctx.on.update_status(), State(leader=True))
+    # THEN the unit status reports it
+    assert state_out.unit_status == ops.ActiveStatus(
+        "profiling machine <testing>, no profiling ingester/backend connected, "
+        "memory limiter refusing profiles"
+    )
+
+    # AND WHEN no more profiles are refused by the next hook
+    state_out = ctx.run(ctx.on.update_status(), state_out)
+    # THEN the unit status goes back to normal
+    assert state_out.unit_status == ops.ActiveStatus(
+        "profiling machine <testing>, no profiling ingester/backend connected"
+    )
+
+
+def test_adaptive_sampling_follows_host_load(ctx, snap_mocks):
+    def sampling_frequency():
+        config = yaml.safe_load(snap_mocks.snap_mgmt.update_config.call_args[0][0])
+        return config["receivers"]["profiling"]["SamplesPerSecond"]
+
+    state = State(leader=True, config={"adaptive_sampling": True, "min_sampling_frequency": 4})
+    with patch("os.cpu_count", return_value=2), patch("os.getloadavg") as loadavg:
+        # GIVEN an idle host
+        loadavg.return_value = (0.2, 0.2, 0.2)
+        state_out = ctx.run(ctx.on.update_status(), state)
+        # THEN the profiler samples at the maximum frequency
+        assert sampling_frequency() == 19
+        assert snap_mocks.snap_mgmt.update_config.call_count == 1
+
+        # WHEN the host load rises, but stays within the same band
+        loadavg.return_value = (0.8, 0.2, 0.2)
+        state_out = ctx.run(ctx.on.update_status(), state_out)
+        # THEN the config is left alone
+        assert snap_mocks.snap_mgmt.update_config.call_count == 1
+
+        # WHEN the host gets saturated
+        loadavg.return_value = (4.0, 1.0, 0.5)
+        state_out = ctx.run(ctx.on.update_status(), state_out)
+        # THEN the profiler is throttled down to the minimum frequency
+        assert snap_mocks.snap_mgmt.update_config.call_count == 2
+        assert sampling_frequency() == 4
+
+        # AND WHEN adaptive sampling gets disabled
+        ctx.run(
+            ctx.on.config_changed(),
+            dataclasses.replace(state_out, config={"sampling_frequency": 7}),
+        )
+        # THEN the operator's sampling frequency is used as is
+        assert sampling_frequency() == 7
+
+
+def test_reconcile_defers_work_over_budget(ctx, snap_mocks):
+    # GIVEN a hook time budget that's used up as soon as the first step ran
+    state = State(leader=True, config={"reconcile_time_budget": "1ns"})
+    with (
+        patch("charm.shutil.which", return_value="/usr/bin/juju-exec"),
+        patch("charm.subprocess.Popen") as popen,
+    ):
+        # WHEN a hook fires
+        state_out = ctx.run(ctx.on.update_status(), state)
+
+    # THEN the config reconcile is deferred
+    assert not snap_mocks.snap_mgmt.update_config.called
+    assert state_out.unit_status == ops.ActiveStatus(
+        "profiling machine <testing>, no profiling ingester/backend connected, "
+        "deferred: config, reload"
+    )
+    # AND a one-shot hook is dispatched to run it
+    juju_exec, unit, command = popen.call_args[0][0]
+    assert (juju_exec, unit) == ("/usr/bin/juju-exec", "otel-ebpf-profiler/0")
+    assert command.startswith("JUJU_DISPATCH_PATH=hooks/update-status ")
+
+    # AND WHEN the next hook fires, with time to spare
+    with patch("charm.shutil.which", return_value=None):
+        state_out = ctx.run(
+            ctx.on.update_status(),
+            dataclasses.replace(state_out, config={"reconcile_time_budget": "0s"}),
+        )
+    # THEN the deferred work is done
+    assert snap_mocks.snap_mgmt.update_config.called
+    assert state_out.unit_status == ops.ActiveStatus(
+        "profiling machine <testing>, no profiling ingester/backend connected"
+    )
+
+
+def _scheduler_deferring_after(step):
+    """Return a WorkScheduler factory whose budget is used up once `step` ran."""
+
+    def scheduler(budget):
+        ran = []
+        scheduler = WorkScheduler(1.0, clock=lambda: 2.0 if step in ran else 0.0)
+        add = scheduler.add
+        scheduler.add = lambda name, run: add(name, lambda: (run(), ran.append(name)))
+        return scheduler
+
+    return scheduler
+
+
+def test_reconcile_resumes_deferred_steps(ctx, snap_mocks):
+    # GIVEN a hook wrote the config, but ran out of time before reloading the profiler
+    with (
+        patch("charm.WorkScheduler", _scheduler_deferring_after("config")),
+        patch("charm.shutil.which", return_value=None),
+    ):
+        state_out = ctx.run(ctx.on.update_status(), State(leader=True))
+    assert snap_mocks.snap_mgmt.update_config.call_count == 1
+    assert not snap_mocks.snap_mgmt.reload.called
+
+    # WHEN the next hook fires, with unchanged inputs
+    state_out = ctx.run(ctx.on.update_status(), state_out)
+
+    # THEN only the deferred reload runs
+    assert snap_mocks.snap_mgmt.update_config.call_count == 1
+    assert snap_mocks.snap_mgmt.reload.call_count == 1
+    # AND once it's done, the next hook takes the fast path
+    ctx.run(ctx.on.update_status(), state_out)
+    assert snap_mocks.snap_mgmt.update_config.call_count == 1
+    assert snap_mocks.snap_mgmt.reload.call_count == 1
+
+
+def test_reconcile_deferred_work_skips_fast_path(ctx, snap_mocks):
+    # GIVEN a full reconcile went through
+    state_out = ctx.run(ctx.on.update_status(), State(leader=True))
+    # AND a config change was written, but its reload deferred
+    with (
+        patch("charm.WorkScheduler", _scheduler_deferring_after("config")),
+        patch("charm.shutil.which", return_value=None),
+    ):
+        state_out = ctx.run(
+            ctx.on.config_changed(),
+            dataclasses.replace(state_out, config={"sampling_frequency": 50}),
+        )
+    assert snap_mocks.snap_mgmt.update_config.call_count == 2
+    reloads = snap_mocks.snap_mgmt.reload.call_count
+
+    # WHEN the config reverts to what the full reconcile ran with
+    ctx.run(ctx.on.config_changed(), dataclasses.replace(state_out, config={}))
+
+    # THEN the config is rewritten and the profiler reloaded, rather than taking the fast path
+    assert snap_mocks.snap_mgmt.update_config.call_count == 3
+    assert snap_mocks.snap_mgmt.reload.call_count == reloads + 1
+
+
+def test_reconcile_fast_path_detects_config_drift(ctx, snap_mocks):
+    # GIVEN a first hook went through a full reconcile, and recorded the config file's signature
+    signature = snap_management.ConfigSignature(inode=1, size=100, mtime_ns=1, hash="cafe")
+    snap_mocks.snap_mgmt.ConfigSignature = snap_management.ConfigSignature
+    snap_mocks.snap_mgmt.config_signature.return_value = signature
+    state_out = ctx.run(ctx.on.update_status(), State(leader=True))
+    ctx.run(ctx.on.update_status(), state_out)
+    assert snap_mocks.snap_mgmt.update_config.call_count == 1
+
+    # WHEN the config file gets edited by hand
+    snap_mocks.snap_mgmt.config_signature.return_value = signature._replace(mtime_ns=2)
+    ctx.run(ctx.on.update_status(), state_out)
+
+    # THEN the config gets reconciled again, against the signature we last verified
+    assert snap_mocks.snap_mgmt.update_config.call_count == 2
+    assert snap_mocks.snap_mgmt.update_config.call_args[0][2] == signature
@@ -0,0 +1,14 @@
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from fake_snapd import FakeSnapd
+
+
+@pytest.fixture
+def fake_snapd():
+    # unix socket paths are limited to ~100 characters, so keep it short
+    with tempfile.TemporaryDirectory(prefix="snapd") as tmp:
+        with FakeSnapd(str(Path(tmp) / "snapd.socket")) as snapd:
+            yield snapd
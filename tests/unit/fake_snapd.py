@@ -0,0 +1,167 @@
+"""A fake snapd, serving the subset of its REST API the charm uses over a unix socket."""
+
+import json
+import socket
+import socketserver
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from typing import Any, Dict, List, NamedTuple, Optional
+
+
+class Request(NamedTuple):
+    """A request the fake snapd received."""
+
+    method: str
+    path: str
+    query: Dict[str, List[str]]
+    body: Any
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+    def do_GET(self):  # noqa: N802
+        self._handle()
+
+    def do_POST(self):  # noqa: N802
+        self._handle()
+
+    def do_PUT(self):  # noqa: N802
+        self._handle()
+
+    def _handle(self):
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        request = Request(self.command, url.path, urllib.parse.parse_qs(url.query), body)
+        status, response = self.server.snapd.handle(request)
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    snapd: "FakeSnapd"
+
+    def get_request(self):
+        request = super().get_request()
+        with self.snapd._lock:
+            self.snapd.connections += 1
+            self.snapd._sockets.append(request[0])
+        return request
+
+
+class FakeSnapd:
+    """Fake snapd server.
+
+    Async changes report "Doing" for `polls_per_change` polls before they're "Done", unless
+    their snap is listed in `failing_snaps`.
+    """
+
+    def __init__(self, socket_path: str, polls_per_change: int = 0):
+        self.socket_path = socket_path
+        self.polls_per_change = polls_per_change
+        self.failing_snaps: List[str] = []
+        self.snaps: Dict[str, Dict[str, Any]] = {}
+        self.requests: List[Request] = []
+        self.connections = 0
+        self._changes: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._sockets: List[socket.socket] = []
+        self._server: Optional[_Server] = None
+
+    def __enter__(self) -> "FakeSnapd":
+        """Start serving on the socket, in a background thread."""
+        self._server = _Server(self.socket_path, _Handler)
+        self._server.snapd = self
+        threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+        ).start()
+        return self
+
+    def __exit__(self, *_):
+        """Stop serving."""
+        assert self._server
+        self._server.shutdown()
+        self._server.server_close()
+
+    def drop_connections(self):
+        """Close the connections clients keep open, like snapd does when they're idle."""
+        with self._lock:
+            for sock in self._sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self._sockets.clear()
+
+    def handle(self, request: Request):
+        """Serve a request; return the HTTP status and the JSON response."""
+        with self._lock:
+            self.requests.append(request)
+            return self._route(request)
+
+    def _route(self, request: Request):
+        parts = request.path.removeprefix("/v2/").split("/")
+        if request.method == "GET" and parts == ["snaps"]:
+            return self._sync(list(self.snaps.values()))
+        if request.method == "GET" and parts == ["apps"]:
+            name = request.query["names"][0]
+            return self._sync([{"snap": name, "name": name, "daemon": "simple"}])
+        if request.method == "GET" and parts[0] == "changes":
+            return self._poll(parts[1])
+        if request.method == "POST" and parts[0] == "snaps":
+            return self._snap_action(parts[1], request.body)
+        if request.method == "POST" and parts == ["apps"]:
+            name = request.body["names"][0].split(".")[0]
+            return self._async(request.body["action"], name)
+        if request.method == "PUT" and parts[0] == "snaps" and parts[2:] == ["conf"]:
+            return self._async("configure-snap", parts[1])
+        return 404, {"type": "error", "status-code": 404, "result": {"message": "not found"}}
+
+    def _snap_action(self, name: str, body: Dict[str, Any]):
+        action = body["action"]
+        if action != "install" and name not in self.snaps:
+            message = {"message": f'snap "{name}" is not installed', "kind": "snap-not-installed"}
+            return 404, {"type": "error", "status-code": 404, "result": message}
+        if action in ("install", "refresh"):
+            self.snaps[name] = {
+                "name": name,
+                "revision": body.get("revision", "1"),
+                "channel": body.get("channel", "latest/stable"),
+                "confinement": "classic" if body.get("classic") else "strict",
+                "version": "1.0",
+            }
+        elif action == "hold":
+            self.snaps[name]["hold"] = body["time"]
+        return self._async(f"{action}-snap", name)
+
+    @staticmethod
+    def _sync(result: Any):
+        return 200, {"type": "sync", "status-code": 200, "status": "OK", "result": result}
+
+    def _async(self, kind: str, name: str):
+        change_id = str(len(self._changes) + 1)
+        status = "Error" if name in self.failing_snaps else "Done"
+        self._changes[change_id] = {"kind": kind, "status": status, "polls": 0}
+        return 202, {
+            "type": "async",
+            "status-code": 202,
+            "status": "Accepted",
+            "change": change_id,
+        }
+
+    def _poll(self, change_id: str):
+        change = self._changes[change_id]
+        change["polls"] += 1
+        status = change["status"] if change["polls"] > self.polls_per_change else "Doing"
+        return self._sync({"id": change_id, "kind": change["kind"], "status": status})
@@ -0,0 +1,81 @@
+from unittest.mock import patch
+
+import pytest
+
+import adaptive_sampling
+from adaptive_sampling import HostLoad, ProfilerCpuReading
+from config_builder import ConfigError
+from profiler_metrics import parse
+
+
+@pytest.mark.parametrize(
+    "current_band, load_per_cpu, band",
+    (
+        (0, 0.1, 0),
+        (0, 0.5, 1),
+        (0, 0.8, 2),
+        (0, 3.0, 3),
+        (1, 0.6, 1),
+        # the load must clearly drop below a band's threshold before we step down
+        (2, 0.7, 2),
+        (2, 0.6, 1),
+        (3, 0.1, 0),
+    ),
+)
+def test_target_band_follows_load(current_band, load_per_cpu, band):
+    assert adaptive_sampling.target_band(current_band, HostLoad(load_per_cpu, None)) == band
+
+
+@pytest.mark.parametrize(
+    "current_band, share, band",
+    (
+        # over budget: throttle one more band, whatever the load
+        (0, 0.02, 1),
+        (1, 0.02, 2),
+        (3, 0.02, 3),
+        # back within budget, but not by much: stay
+        (2, 0.008, 2),
+        # well within budget: follow the load
+        (2, 0.001, 0),
+    ),
+)
+def test_target_band_bounds_profiler_cpu(current_band, share, band):
+    assert adaptive_sampling.target_band(current_band, HostLoad(0.1, share)) == band
+
+
+@pytest.mark.parametrize("band, frequency", ((0, 19), (1, 14), (2, 10), (3, 5), (7, 5)))
+def test_sampling_frequency(band, frequency):
+    assert (
+        adaptive_sampling.sampling_frequency(band, min_frequency=5, max_frequency=19) == frequency
+    )
+
+
+@pytest.mark.parametrize("min_frequency", (0, 20))
+def test_sampling_frequency_invalid_bounds(min_frequency):
+    with pytest.raises(ConfigError):
+        adaptive_sampling.sampling_frequency(0, min_frequency=min_frequency, max_frequency=19)
+
+
+def test_read_profiler_cpu():
+    # GIVEN a scrape without the profiler's CPU counter
+    assert adaptive_sampling.read_profiler_cpu(parse("up 1\n")) is None
+    assert adaptive_sampling.read_profiler_cpu(None) is None
+    # WHEN the counter is there
+    reading = adaptive_sampling.read_profiler_cpu(
+        parse('otelcol_process_cpu_seconds{service_name="x"} 12.5\n')
+    )
+    # THEN we read it
+    assert reading is not None and reading.cpu_seconds == 12.5
+
+
+@patch("os.cpu_count", return_value=4)
+@patch("os.getloadavg", return_value=(2.0, 1.0, 1.0))
+def test_measure(*_):
+    # GIVEN the profiler used 2 CPU seconds in 100 seconds
+    previous = ProfilerCpuReading(cpu_seconds=10.0, timestamp=1000.0)
+    current = ProfilerCpuReading(cpu_seconds=12.0, timestamp=1100.0)
+    # THEN its share of the 4 CPUs is 0.5%
+    assert adaptive_sampling.measure(previous, current) == HostLoad(0.5, 0.005)
+    # AND the share is unknown on the first reading, or if the profiler restarted
+    assert adaptive_sampling.measure(None, current).profiler_cpu_share is None
+    assert adaptive_sampling.measure(current, previous).profiler_cpu_share is None
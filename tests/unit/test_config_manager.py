@@ -0,0 +1,24 @@
+from charms.pyroscope_coordinator_k8s.v0.profiling import Endpoint
+from config_manager import pick_endpoint
+
+
+def test_pick_endpoint_spreads_hosts():
+    # GIVEN four backends
+    endpoints = [Endpoint(f"backend{i}:4317") for i in range(4)]
+    # WHEN a fleet of hosts picks one each
+    picks = [pick_endpoint(endpoints, f"host-{i}").otlp_grpc for i in range(1000)]
+    # THEN each backend gets a fair share of the hosts
+    for endpoint in endpoints:
+        assert 150 < picks.count(endpoint.otlp_grpc) < 350
+
+
+def test_pick_endpoint_consistent():
+    # GIVEN three backends
+    endpoints = [Endpoint(f"backend{i}:4317") for i in range(3)]
+    before = {f"host-{i}": pick_endpoint(endpoints, f"host-{i}") for i in range(1000)}
+    # WHEN a fourth backend is added
+    after = {host: pick_endpoint([*endpoints, Endpoint("backend3:4317")], host) for host in before}
+    # THEN only the hosts moving to the new backend change backend
+    moved = [host for host in before if before[host] != after[host]]
+    assert all(after[host].otlp_grpc == "backend3:4317" for host in moved)
+    assert 150 < len(moved) < 350
@@ -0,0 +1,108 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+import host_capabilities
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path):
+    pth = tmp_path / "caps.json"
+    with patch.object(host_capabilities, "HOST_CAPABILITIES_PATH", pth):
+        host_capabilities.clear_cache()
+        yield pth
+        host_capabilities.clear_cache()
+
+
+@pytest.fixture(autouse=True)
+def boot_id(tmp_path):
+    pth = tmp_path / "boot_id"
+    pth.write_text("boot-1\n")
+    with patch.object(host_capabilities, "BOOT_ID_PATH", pth):
+        yield pth
+
+
+@pytest.fixture
+def probe():
+    with (
+        patch("subprocess.getoutput", return_value="kvm") as getoutput,
+        patch("platform.release", return_value="6.8.0-45-generic"),
+        patch("platform.machine", return_value="x86_64"),
+    ):
+        yield getoutput
+
+
+def test_probe(probe):
+    # WHEN we get the host capabilities of a kvm machine with a recent kernel
+    caps = host_capabilities.get_host_capabilities()
+    # THEN we get a report of what the host supports
+    assert caps.virt_type == "kvm"
+    assert caps.kernel_release == "6.8.0-45-generic"
+    assert caps.kernel_version == (6, 8)
+    assert not caps.in_container
+    assert caps.ebpf_supported
+
+
+@pytest.mark.parametrize("virt_type", ("lxc", "docker"))
+def test_container_not_supported(probe, virt_type):
+    # GIVEN the unit runs in a container
+    probe.return_value = virt_type
+    # WHEN we get the host capabilities
+    caps = host_capabilities.get_host_capabilities()
+    # THEN eBPF is not supported
+    assert caps.in_container
+    assert not caps.ebpf_supported
+
+
+@pytest.mark.parametrize(
+    "arch, release, supported",
+    (
+        ("x86_64", "4.15.0-20-generic", False),
+        ("x86_64", "4.19.0", True),
+        ("aarch64", "5.4.0-100-generic", False),
+        ("aarch64", "5.15.0-100-generic", True),
+    ),
+)
+def test_kernel_version(probe, arch, release, supported):
+    # GIVEN a kernel release on a given arch
+    with (
+        patch("platform.release", return_value=release),
+        patch("platform.machine", return_value=arch),
+    ):
+        # WHEN we get the host capabilities
+        caps = host_capabilities.get_host_capabilities()
+    # THEN eBPF is supported only on recent enough kernels
+    assert caps.ebpf_supported is supported
+
+
+def test_probed_once_across_dispatches(probe, cache_path):
+    # GIVEN the capabilities have been probed in a previous hook
+    host_capabilities.get_host_capabilities()
+    host_capabilities._capabilities = None
+    # WHEN we get them again
+    caps = host_capabilities.get_host_capabilities()
+    # THEN they come from the on-disk cache
+    assert probe.call_count == 1
+    assert json.loads(cache_path.read_text())["virt_type"] == caps.virt_type
+
+
+def test_probed_again_after_reboot(probe, boot_id):
+    # GIVEN the capabilities have been probed
+    host_capabilities.get_host_capabilities()
+    # WHEN the machine reboots
+    boot_id.write_text("boot-2\n")
+    caps = host_capabilities.get_host_capabilities()
+    # THEN they are probed again
+    assert probe.call_count == 2
+    assert caps.boot_id == "boot-2"
+
+
+def test_corrupt_cache(probe, cache_path):
+    # GIVEN a corrupt cache
+    cache_path.write_text("{not json")
+    # WHEN we get the host capabilities
+    caps = host_capabilities.get_host_capabilities()
+    # THEN they are probed again
+    assert caps.virt_type == "kvm"
+    assert probe.call_count == 1
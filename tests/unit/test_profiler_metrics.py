@@ -0,0 +1,81 @@
+from unittest.mock import patch
+
+import profiler_metrics
+
+METRICS = """\
+# HELP otelcol_process_cpu_seconds Total CPU user and system time in seconds
+# TYPE otelcol_process_cpu_seconds counter
+otelcol_process_cpu_seconds{service_name="otelcol-ebpf-profiler"} 12.5
+otelcol_processor_incoming_items_total{otel_signal="profiles",processor="memory_limiter/profiling"} 50
+otelcol_processor_outgoing_items_total{otel_signal="profiles",processor="memory_limiter/profiling"} 45
+otelcol_processor_incoming_items_total{otel_signal="profiles",processor="other"} 100
+target_info{service_name="otelcol-ebpf-profiler",charm_config_generation="0123abcd"} 1
+malformed line
+"""
+
+
+def test_parse():
+    # WHEN we parse a scrape
+    samples = profiler_metrics.parse(METRICS)
+    # THEN we get all the samples, with their labels
+    assert len(samples) == 5
+    assert samples[0] == profiler_metrics.Sample(
+        "otelcol_process_cpu_seconds", {"service_name": "otelcol-ebpf-profiler"}, 12.5
+    )
+
+
+def test_total():
+    # GIVEN a scrape
+    samples = profiler_metrics.parse(METRICS)
+    # WHEN we sum the samples matching a prefix and some labels
+    incoming = profiler_metrics.total(
+        samples, "otelcol_processor_incoming_items", otel_signal="profiles"
+    )
+    # THEN only the matching samples are summed
+    assert incoming == 150
+
+
+def test_processor_dropped_items():
+    # GIVEN a scrape
+    samples = profiler_metrics.parse(METRICS)
+    # WHEN we count the profiles the memory limiter didn't pass on
+    dropped = profiler_metrics.processor_dropped_items(
+        samples, "memory_limiter/profiling", signal="profiles"
+    )
+    # THEN we get the difference between the items going in and out of it
+    assert dropped == 5
+
+
+def test_scrape_unreachable():
+    # GIVEN the profiler isn't listening
+    with patch.object(profiler_metrics, "METRICS_URL", "http://localhost:1/metrics"):
+        # WHEN we scrape it
+        # THEN we get nothing
+        assert profiler_metrics.scrape(timeout=0.1) is None
+
+
+def test_config_generation():
+    # GIVEN a scrape of a profiler running a config generation
+    samples = profiler_metrics.parse(METRICS)
+    # THEN we can tell which
+    assert profiler_metrics.config_generation(samples) == "0123abcd"
+    assert profiler_metrics.config_generation(samples[:2]) is None
+
+
+def test_wait_for_config_generation():
+    # GIVEN a profiler that is down, then runs the old config, then the new one
+    old = METRICS.replace("0123abcd", "old")
+    scrapes = [None, profiler_metrics.parse(old), profiler_metrics.parse(METRICS)]
+    with patch.object(profiler_metrics, "scrape", side_effect=scrapes):
+        # WHEN we wait for the new config
+        elapsed = profiler_metrics.wait_for_config_generation("0123abcd", timeout=5, interval=0)
+    # THEN we get how long it took
+    assert elapsed is not None and elapsed >= 0
+
+
+def test_wait_for_config_generation_timeout():
+    # GIVEN a profiler that keeps running the old config
+    with patch.object(profiler_metrics, "scrape", return_value=profiler_metrics.parse(METRICS)):
+        # WHEN we wait for a new config
+        # THEN we give up after the timeout
+        assert profiler_metrics.wait_for_config_generation("new", timeout=0, interval=0) is None
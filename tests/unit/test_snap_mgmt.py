@@ -1,13 +1,40 @@
+import os
+import stat
+import subprocess
 from collections import namedtuple
 from unittest.mock import patch, MagicMock
 
 import pytest
 
+import host_capabilities
 import snap_management
-from charms.operator_libs_linux.v2.snap import SnapState
+from charms.operator_libs_linux.v2.snap import SnapAPIError, SnapNotFoundError
+from config_builder import sha256
+from snapd_client import SnapdClient
 
 CfgMocks = namedtuple("CfgMocks", "config, hash")
 
+ACTIVE = {"LoadState": "loaded", "ActiveState": "active"}
+ACTIVATING = {"LoadState": "loaded", "ActiveState": "activating"}
+INACTIVE = {"LoadState": "loaded", "ActiveState": "inactive"}
+FAILED = {"LoadState": "loaded", "ActiveState": "failed"}
+NOT_FOUND = {"LoadState": "not-found", "ActiveState": "inactive"}
+
+
+@pytest.fixture(autouse=True)
+def clean_snap_state():
+    snap_management.invalidate_snap_state()
+    yield
+    snap_management.invalidate_snap_state()
+
+
+@pytest.fixture(autouse=True)
+def mock_host_capabilities_cache(tmp_path):
+    with patch.object(host_capabilities, "HOST_CAPABILITIES_PATH", tmp_path / "caps.json"):
+        host_capabilities.clear_cache()
+        yield
+        host_capabilities.clear_cache()
+
 
 @pytest.fixture
 def mock_paths(tmp_path):
@@ -18,62 +45,96 @@ def mock_paths(tmp_path):
         yield CfgMocks(cfg, hsh)
 
 
+def _config_file(config: str) -> str:
+    return f"{snap_management.CONFIG_HASH_HEADER}{sha256(config)}\n{config}"
+
+
+def _temp_files(mock_paths):
+    return list(mock_paths.config.parent.glob(".config.yaml.*"))
+
+
 def test_update_config_no_changes(mock_paths):
-    # GIVEN an initial foo/foo content
-    mock_paths.config.write_text("foo")
-    mock_paths.hash.write_text("foo")
+    # GIVEN an initial foo content
+    mock_paths.config.write_text(_config_file("foo"))
 
-    # WHEN we call update_config with foo/foo
-    snap_management.update_config("foo", "foo")
+    # WHEN we call update_config with foo
+    assert not snap_management.update_config("foo", sha256("foo"))
 
-    # THEN no file is updated
-    assert mock_paths.config.read_text() == "foo"
-    assert mock_paths.hash.read_text() == "foo"
+    # THEN the file isn't updated
+    assert mock_paths.config.read_text() == _config_file("foo")
 
 
-def test_update_only_hash_changed(mock_paths):
-    # GIVEN an initial foo/foo content
-    mock_paths.config.write_text("foo")
-    mock_paths.hash.write_text("foo")
+@pytest.mark.parametrize(
+    "tamper",
+    (
+        lambda path: path.write_text(path.read_text() + "extensions: {}\n"),
+        lambda path: path.write_text(path.read_text()[:-1]),
+        lambda path: path.write_text(path.read_text().split("\n", 1)[1]),
+        lambda path: path.unlink(),
+    ),
+)
+def test_update_config_corrects_drift(mock_paths, tamper, caplog):
+    # GIVEN a config we wrote
+    assert snap_management.update_config("foo", sha256("foo"))
+    verified = snap_management.config_signature(sha256("foo"))
+    # AND someone edited, truncated or deleted it by hand
+    tamper(mock_paths.config)
 
-    # WHEN we call update_config with foo/bar (technically this shouldn't happen)
-    snap_management.update_config("foo", "bar")
+    # WHEN we call update_config with the same config
+    assert snap_management.update_config("foo", sha256("foo"), verified)
 
-    # THEN the hash file is updated, but the config one remains the same (contents are identical)
-    assert mock_paths.config.read_text() == "foo"
-    assert mock_paths.hash.read_text() == "bar"
+    # THEN the config is restored
+    assert mock_paths.config.read_text() == _config_file("foo")
+    # AND the drift is reported
+    assert "outside of the charm" in caplog.text
 
 
-def test_update_config_changed_but_not_hash(mock_paths):
-    # GIVEN an initial foo/foo content
-    mock_paths.config.write_text("foo")
-    mock_paths.hash.write_text("foo")
+def test_update_config_verified_signature_skips_read(mock_paths):
+    # GIVEN a config we wrote, and its signature
+    assert snap_management.update_config("foo", sha256("foo"))
+    verified = snap_management.config_signature(sha256("foo"))
 
-    # WHEN we call update_config with bar/foo (technically this shouldn't happen)
-    snap_management.update_config("bar", "foo")
+    # WHEN we call update_config with the same config and signature
+    with patch.object(snap_management.Path, "read_text", side_effect=AssertionError("read")):
+        # THEN the file is left alone, without being read
+        assert not snap_management.update_config("foo", sha256("foo"), verified)
 
-    # THEN no file is updated
-    assert mock_paths.config.read_text() == "foo"
-    assert mock_paths.hash.read_text() == "foo"
+    # AND a stale signature falls back to reading the file
+    stale = verified._replace(mtime_ns=verified.mtime_ns - 1)
+    assert not snap_management.update_config("foo", sha256("foo"), stale)
 
 
 def test_happy_path(mock_paths):
     # GIVEN an initial foo/foo content
+    mock_paths.config.write_text(_config_file("foo"))
+
+    # WHEN we call update_config with bar/bar
+    assert snap_management.update_config("bar", sha256("bar"))
+
+    # THEN the config is replaced, along with its hash
+    assert mock_paths.config.read_text() == _config_file("bar")
+    assert mock_paths.config.stat().st_mode & 0o777 == 0o644
+    assert not _temp_files(mock_paths)
+
+
+def test_update_config_migrates_hash_lockfile(mock_paths):
+    # GIVEN a config written by an older charm revision, with its hash in a separate file
     mock_paths.config.write_text("foo")
     mock_paths.hash.write_text("foo")
 
-    # WHEN we call update_config with bar/bar
-    snap_management.update_config("bar", "bar")
+    # WHEN we call update_config with the same content
+    assert snap_management.update_config("foo", sha256("foo"))
 
-    # THEN no file is updated
-    assert mock_paths.config.read_text() == "bar"
-    assert mock_paths.hash.read_text() == "bar"
+    # THEN the config is rewritten with its hash embedded, and the old hash file is gone
+    assert mock_paths.config.read_text() == _config_file("foo")
+    assert not mock_paths.hash.exists()
 
 
 def test_cleanup(mock_paths):
-    # GIVEN an initial foo/foo content
-    mock_paths.config.write_text("foo")
+    # GIVEN an initial config, a legacy hash file and a leftover temporary file
+    mock_paths.config.write_text(_config_file("foo"))
     mock_paths.hash.write_text("foo")
+    (mock_paths.config.parent / ".config.yaml.abc.tmp").write_text("fo")
 
     # WHEN we call cleanup_config
     snap_management.cleanup_config()
@@ -81,13 +142,81 @@ def test_cleanup(mock_paths):
     # THEN the files are gone
     assert not mock_paths.config.exists()
     assert not mock_paths.hash.exists()
+    assert not _temp_files(mock_paths)
+
+
+class _Crash(BaseException):
+    """Simulates the hook process dying at some point of the write."""
+
+
+def _crash(*_, **__):
+    raise _Crash()
+
+
+@pytest.mark.parametrize(
+    "crash_point",
+    (
+        # while writing the temporary file
+        "os.fsync",
+        "os.fchmod",
+        # right before the rename
+        "os.replace",
+    ),
+)
+def test_crash_before_rename_keeps_old_config(mock_paths, crash_point):
+    # GIVEN an initial config
+    mock_paths.config.write_text(_config_file("foo"))
+
+    # WHEN the write crashes before the new config is renamed into place
+    with patch(f"snap_management.{crash_point}", _crash), pytest.raises(_Crash):
+        snap_management.update_config("bar", sha256("bar"))
+
+    # THEN the old config, with its matching hash, is left untouched
+    assert mock_paths.config.read_text() == _config_file("foo")
+    assert not _temp_files(mock_paths)
+    # AND the next write goes through
+    assert snap_management.update_config("bar", sha256("bar"))
+    assert mock_paths.config.read_text() == _config_file("bar")
+
+
+def test_crash_with_partial_temp_file(mock_paths):
+    # GIVEN an initial config
+    mock_paths.config.write_text(_config_file("foo"))
+    # AND a process killed mid-write, which left a truncated temporary file behind
+    (mock_paths.config.parent / ".config.yaml.x1y2.tmp").write_text(_config_file("bar")[:5])
+
+    # THEN the profiler still sees the old config
+    assert mock_paths.config.read_text() == _config_file("foo")
+    # AND the next write replaces it, and clears the leftovers
+    assert snap_management.update_config("bar", sha256("bar"))
+    assert mock_paths.config.read_text() == _config_file("bar")
+    assert not _temp_files(mock_paths)
+
+
+def test_crash_after_rename_keeps_new_config(mock_paths):
+    # GIVEN an initial config
+    mock_paths.config.write_text(_config_file("foo"))
+
+    # WHEN the write crashes after the rename, while syncing the directory
+    real_fsync = os.fsync
+
+    def crash_on_dir_fsync(fd):
+        if stat.S_ISDIR(os.fstat(fd).st_mode):
+            raise _Crash()
+        real_fsync(fd)
+
+    with patch("snap_management.os.fsync", crash_on_dir_fsync), pytest.raises(_Crash):
+        snap_management.update_config("bar", sha256("bar"))
+
+    # THEN the new config is complete, and carries its own hash
+    assert mock_paths.config.read_text() == _config_file("bar")
+    # AND it isn't rewritten
+    assert not snap_management.update_config("bar", sha256("bar"))
 
 
 def test_check_status_snap_absent(caplog):
     # GIVEN the snap is absent
-    foo_snap = MagicMock()
-    with patch("snap_management.SnapCache", return_value={"foo": foo_snap}):
-        foo_snap.state = SnapState.Absent
+    with patch.object(snap_management, "_systemctl_show", return_value=NOT_FOUND):
         # WHEN we call check_status
         status = snap_management.check_status("foo", "bar")
 
@@ -98,12 +227,10 @@ def test_check_status_snap_absent(caplog):
 
 def test_check_status_service_inactive(caplog):
     # GIVEN the snap service is inactive
-    foo_snap = MagicMock()
-    with patch("snap_management.SnapCache", return_value={"foo": foo_snap}):
-        foo_snap.services = {"bar": {"active": False}}
-
-        # WHEN we call check_status
-        status = snap_management.check_status("foo", "bar")
+    with patch.object(snap_management, "_systemctl_show", return_value=INACTIVE):
+        with patch("subprocess.getoutput", return_value="none"):
+            # WHEN we call check_status
+            status = snap_management.check_status("foo", "bar")
 
     # THEN check_status returns an error message
     assert status is not None
@@ -112,9 +239,7 @@ def test_check_status_service_inactive(caplog):
 
 def test_check_status_bad_virt_type(caplog):
     # GIVEN a lxc virt-type
-    foo_snap = MagicMock()
-    with patch("snap_management.SnapCache", return_value={"foo": foo_snap}):
-        foo_snap.services = {"bar": {"active": False}}
+    with patch.object(snap_management, "_systemctl_show", return_value=INACTIVE):
         with patch("subprocess.getoutput", return_value="lxc"):
             # WHEN we call check_status
             with caplog.at_level("ERROR"):
@@ -131,9 +256,7 @@ def test_check_status_bad_virt_type(caplog):
 
 def test_check_status_not_running(caplog):
     # GIVEN the snap isn't running for any reason
-    foo_snap = MagicMock()
-    with patch("snap_management.SnapCache", return_value={"foo": foo_snap}):
-        foo_snap.services = {"bar": {"active": False}}
+    with patch.object(snap_management, "_systemctl_show", return_value=INACTIVE):
         with patch("subprocess.getoutput", return_value="kvm"):
             # WHEN we call check_status
             status = snap_management.check_status("foo", "bar")
@@ -141,3 +264,224 @@ def test_check_status_not_running(caplog):
     # THEN check_status returns an error message
     assert status is not None
     assert "snap is not running" in status
+
+
+def test_check_status_active():
+    # GIVEN the snap service is running
+    with patch.object(snap_management, "_systemctl_show", return_value=ACTIVE) as show:
+        # WHEN we call check_status
+        status = snap_management.check_status("foo", "bar")
+
+    # THEN check_status returns nothing
+    assert status is None
+    # AND THEN we queried the service's systemd unit once, without waiting
+    show.assert_called_once_with("snap.foo.bar.service")
+
+
+def test_service_state_waits_for_transition():
+    # GIVEN the snap service is starting up, and fails shortly after
+    with patch.object(
+        snap_management, "_systemctl_show", side_effect=[ACTIVATING, ACTIVATING, FAILED]
+    ):
+        # WHEN we get the service state
+        state = snap_management.service_state("foo", "bar")
+
+    # THEN we get the state it settled into
+    assert state.active_state == "failed"
+
+
+def test_service_state_bounded_wait():
+    # GIVEN the snap service is stuck starting up
+    with patch.object(snap_management, "_systemctl_show", return_value=ACTIVATING):
+        # WHEN we get the service state
+        state = snap_management.service_state("foo", "bar", timeout=0.1)
+
+    # THEN we give up waiting and return the transient state
+    assert state.active_state == "activating"
+
+
+def _installed(name, revision="6"):
+    return {"name": name, "revision": revision, "channel": "stable", "confinement": "classic"}
+
+
+def test_snap_state_loaded_once_per_dispatch():
+    # GIVEN snapd knows about a snap
+    client = MagicMock()
+    client.get_installed_snaps.return_value = [_installed("foo")]
+    with patch.object(snap_management, "get_snapd_client", return_value=client):
+        # WHEN we look the snap up several times
+        for _ in range(5):
+            snap = snap_management.get_snap("foo")
+
+    # THEN snapd has been queried only once
+    assert client.get_installed_snaps.call_count == 1
+    assert (snap.name, snap.revision, snap.present) == ("foo", "6", True)
+
+
+def test_snap_state_invalidated_after_mutation():
+    # GIVEN the snapd state has been loaded
+    client = MagicMock()
+    client.get_installed_snaps.return_value = [_installed("foo")]
+    with patch.object(snap_management, "get_snapd_client", return_value=client):
+        snap_management.get_snap("foo")
+        # WHEN we mutate the snap
+        with patch("subprocess.run"):
+            snap_management.reload("foo", "bar")
+        snap_management.get_snap("foo")
+
+    # THEN the next lookup reloads the snapd state
+    assert client.get_installed_snaps.call_count == 2
+
+
+def test_snap_not_installed():
+    # GIVEN snapd knows about a snap that isn't installed
+    client = MagicMock()
+    client.get_installed_snaps.return_value = []
+    client.get_snap_information.return_value = _installed("foo")
+    with patch.object(snap_management, "get_snapd_client", return_value=client):
+        # WHEN we look it up
+        snap = snap_management.get_snap("foo")
+        # THEN it's reported available, but not present
+        assert not snap.present
+
+        # AND WHEN snapd doesn't know the snap
+        client.get_snap_information.side_effect = SnapAPIError({}, 404, "Not Found", "")
+        # THEN we get an error
+        with pytest.raises(SnapNotFoundError):
+            snap_management.get_snap("bar")
+
+
+@pytest.fixture
+def snapd_client(fake_snapd):
+    client = SnapdClient(socket_path=fake_snapd.socket_path)
+    with patch.object(snap_management, "_snapd_client", client):
+        yield client
+    client.close()
+
+
+def test_snap_state_shares_snapd_client(fake_snapd, snapd_client):
+    # GIVEN snapd has a snap installed
+    fake_snapd.snaps["foo"] = _installed("foo")
+    # WHEN we look it up, and start it
+    snap = snap_management.get_snap("foo")
+    snap_management.start_snap("foo")
+
+    # THEN snapd is queried through the shared client, on a single connection
+    assert snap.revision == "6"
+    assert fake_snapd.connections == 1
+
+
+@pytest.mark.parametrize(
+    "present, revision, action",
+    ((False, "", "install"), (True, "1", "refresh"), (True, "6", None)),
+)
+def test_install_snap(fake_snapd, snapd_client, present, revision, action):
+    # GIVEN the snap is installed, or not, at some revision
+    snap = MagicMock(present=present, revision=revision)
+    if present:
+        fake_snapd.snaps["foo"] = {"name": "foo", "revision": revision}
+    with (
+        patch.object(snap_management, "get_snap", return_value=snap),
+        patch.object(snap_management.SnapMap, "get_revision", return_value=6),
+    ):
+        # WHEN we install it
+        snap_management.install_snap("foo", classic=True, config={"bar": "baz"})
+
+    # THEN it's installed or refreshed if needed, configured and held, through the snapd API
+    requests = [r for r in fake_snapd.requests if not r.path.startswith("/v2/changes/")]
+    expected = [
+        ("PUT", "/v2/snaps/foo/conf", {"bar": "baz"}),
+        ("POST", "/v2/snaps/foo", {"action": "hold", "time": "forever", "hold-level": "general"}),
+    ]
+    if action:
+        body = {"action": action, "revision": "6", "classic": True}
+        expected.insert(0, ("POST", "/v2/snaps/foo", body))
+    assert [(r.method, r.path, r.body) for r in requests] == expected
+
+
+def test_install_snap_failure(fake_snapd, snapd_client):
+    # GIVEN snapd fails to install the snap
+    fake_snapd.failing_snaps.append("foo")
+    snap = MagicMock(present=False)
+    with (
+        patch.object(snap_management, "get_snap", return_value=snap),
+        patch.object(snap_management.SnapMap, "get_revision", return_value=6),
+    ):
+        # WHEN we install it
+        # THEN we get an install error
+        with pytest.raises(snap_management.SnapInstallError):
+            snap_management.install_snap("foo")
+
+
+def test_start_snap(fake_snapd, snapd_client):
+    # WHEN we start the snap
+    snap_management.start_snap("foo", enable=True)
+    # THEN snapd is asked to start and enable all of its services
+    assert fake_snapd.requests[0].body == {"action": "start", "names": ["foo"], "enable": True}
+
+    # AND WHEN snapd fails to start them
+    fake_snapd.failing_snaps.append("foo")
+    # THEN we get a service error
+    with pytest.raises(snap_management.SnapServiceError):
+        snap_management.start_snap("foo")
+
+
+def test_reload_failure_raises():
+    # GIVEN the SIGHUP can't be delivered, e.g. because the unit doesn't exist
+    error = subprocess.CalledProcessError(1, "systemctl")
+    with patch("subprocess.run", side_effect=error):
+        # WHEN we reload the snap
+        # THEN the failure is surfaced
+        with pytest.raises(snap_management.ConfigReloadError):
+            snap_management.reload("foo", "bar")
+
+
+def test_schedule_reload():
+    # GIVEN no reload is scheduled
+    with (
+        patch.object(snap_management, "_systemctl_show", return_value=NOT_FOUND),
+        patch("subprocess.run") as run,
+    ):
+        # WHEN we schedule one
+        assert snap_management.schedule_reload("foo", "bar", 2.5)
+
+    # THEN a transient timer SIGHUPs the service once the window is over
+    cmd = run.call_args[0][0]
+    assert "--unit=foo-reload" in cmd
+    assert "--on-active=2.5s" in cmd
+    assert cmd[-5:] == ["systemctl", "kill", "-s", "SIGHUP", "snap.foo.bar.service"]
+
+
+def test_schedule_reload_coalesces():
+    # GIVEN a reload is already scheduled
+    with (
+        patch.object(snap_management, "_systemctl_show", return_value=ACTIVE),
+        patch("subprocess.run") as run,
+    ):
+        # WHEN we schedule another one
+        assert not snap_management.schedule_reload("foo", "bar", 2.5)
+
+    # THEN the pending one will do
+    assert not run.called
+
+
+def test_schedule_reload_failure_raises():
+    error = subprocess.CalledProcessError(1, "systemd-run")
+    with (
+        patch.object(snap_management, "_systemctl_show", return_value=NOT_FOUND),
+        patch("subprocess.run", side_effect=error),
+    ):
+        with pytest.raises(snap_management.ConfigReloadError):
+            snap_management.schedule_reload("foo", "bar", 2.5)
+
+
+def test_check_status_virt_type_probed_once():
+    # GIVEN the snap service is inactive on a lxc container
+    with patch.object(snap_management, "_systemctl_show", return_value=INACTIVE):
+        with patch("subprocess.getoutput", return_value="lxc") as getoutput:
+            # WHEN we evaluate the status several times
+            for _ in range(3):
+                snap_management.check_status("foo", "bar")
+
+    # THEN the virt-type has been probed only once
+    assert getoutput.call_count == 1
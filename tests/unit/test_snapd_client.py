@@ -0,0 +1,269 @@
+import http.client
+import inspect
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+from charms.operator_libs_linux.v2.snap import SnapAPIError, SnapClient, SnapError
+
+import snapd_client
+from snapd_client import SnapdClient
+
+
+@pytest.fixture
+def client(fake_snapd):
+    client = SnapdClient(socket_path=fake_snapd.socket_path)
+    yield client
+    client.close()
+
+
+@pytest.mark.parametrize(
+    "method, parameters",
+    (
+        # overridden
+        ("_request", ["self", "method", "path", "query", "body"]),
+        ("_wait", ["self", "change_id", "timeout"]),
+        # called
+        ("_put_snap_conf", ["self", "name", "conf"]),
+    ),
+)
+def test_snap_client_internals(method, parameters):
+    # SnapdClient relies on these private methods of the snap library's client, and the library
+    # gets updated automatically: fail if they're gone or changed
+    assert list(inspect.signature(getattr(SnapClient, method)).parameters) == parameters
+    assert list(inspect.signature(getattr(SnapdClient, method)).parameters) == parameters
+    assert "/v2/" in SnapClient().base_url
+
+
+def test_install(client, fake_snapd):
+    # GIVEN snapd takes a few polls to complete changes
+    fake_snapd.polls_per_change = 2
+    # WHEN we install a snap
+    client.install("foo", revision="6", classic=True)
+    # THEN snapd is asked to install it
+    install = fake_snapd.requests[0]
+    assert (install.method, install.path) == ("POST", "/v2/snaps/foo")
+    assert install.body == {"action": "install", "revision": "6", "classic": True}
+    # AND we wait for the change to complete, polling it on the same connection
+    assert [r.path for r in fake_snapd.requests[1:]] == ["/v2/changes/1"] * 3
+    assert fake_snapd.connections == 1
+    assert fake_snapd.snaps["foo"]["revision"] == "6"
+
+
+def test_refresh_hold_and_configure(client, fake_snapd):
+    # GIVEN an installed snap
+    client.install("foo", revision="5")
+    # WHEN we refresh, configure and hold it
+    client.refresh("foo", revision="6", classic=True)
+    client.set_config("foo", {"bar": "baz"})
+    client.hold("foo")
+    # THEN snapd gets the matching requests
+    requests = [r for r in fake_snapd.requests if not r.path.startswith("/v2/changes/")]
+    assert [(r.method, r.path, r.body) for r in requests[1:]] == [
+        ("POST", "/v2/snaps/foo", {"action": "refresh", "revision": "6", "classic": True}),
+        ("PUT", "/v2/snaps/foo/conf", {"bar": "baz"}),
+        ("POST", "/v2/snaps/foo", {"action": "hold", "time": "forever", "hold-level": "general"}),
+    ]
+
+
+@pytest.mark.parametrize(
+    "services, names", ((None, ["foo"]), (["bar", "baz"], ["foo.bar", "foo.baz"]))
+)
+def test_start(client, fake_snapd, services, names):
+    # WHEN we start the snap's services
+    client.start("foo", services=services, enable=True)
+    # THEN snapd is asked to start and enable them
+    assert fake_snapd.requests[0].body == {"action": "start", "names": names, "enable": True}
+
+
+def test_failed_change(client, fake_snapd):
+    # GIVEN snapd fails to install a snap
+    fake_snapd.failing_snaps.append("foo")
+    # WHEN we install it
+    # THEN we get an error
+    with pytest.raises(SnapError):
+        client.install("foo")
+
+
+def test_rejected_request(client):
+    # WHEN snapd rejects a request
+    # THEN we get an API error
+    with pytest.raises(SnapAPIError):
+        client._request("GET", "nope")
+
+
+def test_wait_backs_off(client, fake_snapd):
+    # GIVEN a long-running change
+    fake_snapd.polls_per_change = 7
+    # WHEN we wait for it
+    with patch("time.sleep") as sleep, patch.object(snapd_client, "tracer") as tracer:
+        client.install("foo")
+    # THEN we poll it less and less often, up to a cap
+    assert sleep.call_args_list == [call(d) for d in (0.1, 0.2, 0.4, 0.8, 1.6, 2.0, 2.0)]
+    # AND the polls are recorded on the span
+    span = tracer.start_as_current_span.return_value.__enter__.return_value
+    span.set_attribute.assert_any_call("polls", 8)
+    span.set_attribute.assert_any_call("status", "Done")
+    assert "wait_seconds" in [c.args[0] for c in span.set_attribute.call_args_list]
+
+
+def test_wait_honors_remaining_time_hint(client):
+    # GIVEN a change whose completed tasks hint that it's almost ready
+    doing = {
+        "status": "Doing",
+        "spawn-time": "2025-01-01T00:00:00Z",
+        "tasks": [
+            {"status": "Done", "ready-time": "2025-01-01T00:00:00.2Z"},
+            {"status": "Doing"},
+        ],
+    }
+    changes = [doing] * 5 + [{"status": "Done", "data": "ok"}]
+    with patch.object(client, "_get_change", side_effect=changes), patch("time.sleep") as sleep:
+        # WHEN we wait for it
+        assert client._wait("1") == "ok"
+    # THEN we don't back off past the hint
+    assert sleep.call_args_list == [call(0.1)] + [call(pytest.approx(0.2))] * 4
+
+
+def test_wait_timeout(client):
+    with patch.object(client, "_get_change", return_value={"status": "Doing"}):
+        with pytest.raises(TimeoutError):
+            client._wait("1", timeout=0)
+
+
+@pytest.mark.parametrize(
+    "change, hint",
+    (
+        # 2 tasks out of 4 completed in 3s: 3s to go
+        (
+            {
+                "spawn-time": "2025-01-01T00:00:00Z",
+                "tasks": [
+                    {"ready-time": "2025-01-01T00:00:01.000000001Z"},
+                    {"ready-time": "2025-01-01T00:00:03+00:00"},
+                    {},
+                    {},
+                ],
+            },
+            3.0,
+        ),
+        # no task completed yet
+        ({"spawn-time": "2025-01-01T00:00:00Z", "tasks": [{}, {}]}, None),
+        # all tasks completed
+        (
+            {
+                "spawn-time": "2025-01-01T00:00:00Z",
+                "tasks": [{"ready-time": "2025-01-01T00:00:01Z"}],
+            },
+            None,
+        ),
+        ({}, None),
+    ),
+)
+def test_remaining_time_hint(change, hint):
+    assert snapd_client.remaining_time_hint(change) == (pytest.approx(hint) if hint else None)
+
+
+def test_requests_share_a_connection(client, fake_snapd):
+    # WHEN we make several requests, each waiting for a change
+    client.install("foo", revision="6", classic=True)
+    client.set_config("foo", {"bar": "baz"})
+    client.hold("foo")
+    client.start("foo", enable=True)
+    assert client.get_installed_snaps()[0]["name"] == "foo"
+    # THEN they all go out on a single keep-alive connection
+    assert len(fake_snapd.requests) == 9
+    assert fake_snapd.connections == 1
+
+
+def test_reconnects_after_idle_connection_closed(client, fake_snapd):
+    # GIVEN snapd closed the connection a previous request was served on
+    client.install("foo")
+    fake_snapd.drop_connections()
+    # WHEN we make another request
+    client.hold("foo")
+    # THEN it goes out on a new connection
+    assert fake_snapd.connections == 2
+    assert fake_snapd.snaps["foo"]["hold"] == "forever"
+
+
+def test_unreachable_snapd(tmp_path):
+    # GIVEN snapd isn't listening
+    client = SnapdClient(socket_path=str(tmp_path / "snapd.socket"))
+    # WHEN we make a request
+    # THEN we get an API error, like with the base client
+    with pytest.raises(SnapAPIError) as e:
+        client.get_installed_snaps()
+    assert e.value.code == 500
+
+
+def _response(status=200, body=b'{"type": "sync", "result": "ok"}', will_close=False):
+    response = MagicMock(status=status, reason="OK", will_close=will_close)
+    response.read.return_value = body
+    return response
+
+
+@pytest.mark.parametrize(
+    "method, fail_on, error, retried",
+    (
+        # the request didn't reach snapd
+        ("POST", "request", BrokenPipeError(), True),
+        ("POST", "request", ConnectionResetError(), True),
+        # snapd closed the connection without answering
+        ("POST", "getresponse", http.client.RemoteDisconnected(), True),
+        # snapd may have acted on the request: only a GET is safe to repeat
+        ("POST", "getresponse", ConnectionResetError(), False),
+        ("GET", "getresponse", ConnectionResetError(), True),
+    ),
+)
+def test_pool_retries_on_reset_connection(method, fail_on, error, retried):
+    # GIVEN the pooled connection snapd closed in the meantime
+    pool = snapd_client._ConnectionPool("/nowhere", timeout=1)
+    stale, fresh = MagicMock(), MagicMock()
+    getattr(stale, fail_on).side_effect = error
+    stale.getresponse.return_value = fresh.getresponse.return_value = _response()
+    with (
+        patch.object(pool, "_acquire", return_value=(stale, True)),
+        patch.object(pool, "_connect", return_value=fresh),
+    ):
+        # WHEN we send a request on it
+        if retried:
+            # THEN it's retried on a new connection, which is kept for the next requests
+            assert pool.request(method, "/v2/snaps", None, {}) == (200, "OK", _response().read())
+            assert pool._idle == [fresh]
+        else:
+            # THEN the error is surfaced
+            with pytest.raises(type(error)):
+                pool.request(method, "/v2/snaps", None, {})
+    assert stale.close.called
+
+
+def test_pool_never_retries_new_connection():
+    # GIVEN a new connection, reset by snapd
+    pool = snapd_client._ConnectionPool("/nowhere", timeout=1)
+    connection = MagicMock()
+    connection.request.side_effect = ConnectionResetError()
+    with patch.object(pool, "_connect", return_value=connection):
+        # WHEN we send a request on it
+        # THEN the error is surfaced
+        with pytest.raises(ConnectionResetError):
+            pool.request("GET", "/v2/snaps", None, {})
+    assert connection.request.call_count == 1
+
+
+def test_pool_size_bounded():
+    # GIVEN a pool holding on to at most 2 idle connections
+    pool = snapd_client._ConnectionPool("/nowhere", timeout=1, size=2)
+    connections = [MagicMock() for _ in range(3)]
+    for connection in connections:
+        # WHEN connections are released to it
+        pool._release(connection)
+    # THEN the extra ones are closed
+    assert pool._idle == connections[:2]
+    assert connections[2].close.called
+    # AND a connection snapd asked to close isn't pooled
+    connection = MagicMock()
+    connection.getresponse.return_value = _response(will_close=True)
+    with patch.object(pool, "_acquire", return_value=(connection, False)):
+        pool.request("GET", "/v2/snaps", None, {})
+    assert connection.close.called
+    assert connection not in pool._idle
@@ -0,0 +1,48 @@
+from work_scheduler import WorkScheduler
+
+
+def _scheduler(budget):
+    # every step takes one second
+    ran = []
+    scheduler = WorkScheduler(budget, clock=lambda: float(len(ran)))
+    for name in ("a", "b", "c", "d"):
+        scheduler.add(name, lambda name=name: ran.append(name))
+    return scheduler, ran
+
+
+def test_runs_all_steps_within_budget():
+    scheduler, ran = _scheduler(budget=None)
+    assert scheduler.run() == []
+    assert ran == ["a", "b", "c", "d"]
+
+
+def test_defers_steps_over_budget():
+    # GIVEN a budget that's used up after the first two steps
+    scheduler, ran = _scheduler(budget=2)
+    # WHEN we run the steps
+    deferred = scheduler.run()
+    # THEN the remaining ones are deferred, in order
+    assert ran == ["a", "b"]
+    assert deferred == ["c", "d"]
+
+
+def test_first_step_always_runs():
+    scheduler, ran = _scheduler(budget=0)
+    assert scheduler.run() == ["b", "c", "d"]
+    assert ran == ["a"]
+
+
+def test_remaining_budget():
+    # GIVEN a budget of 3s, and a first step taking 1s
+    ran = []
+    scheduler = WorkScheduler(3, clock=lambda: float(len(ran)))
+    scheduler.add("a", lambda: ran.append("a"))
+    remaining = []
+    scheduler.add("b", lambda: remaining.append(scheduler.remaining()))
+    assert scheduler.remaining() == 3
+    # WHEN the second step checks how much of the budget is left
+    scheduler.run()
+    # THEN it gets what the first step left
+    assert remaining == [2]
+    # AND without a budget, there's no limit
+    assert WorkScheduler(None).remaining() is None